@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Date, cast, delete, func, insert, select, text, update
+
+from geomatch import place_at
+
+# Arbitrary key for pg_try_advisory_xact_lock so only one worker refreshes at a time
+ANALYTICS_LOCK_KEY = 420103
+
+def week_start(expression, dialect):
+    # SQL for the Monday of the week containing `expression` (a date or datetime)
+    if dialect == "postgresql":
+        return cast(func.date_trunc("week", expression), Date)
+    # SQLite: forward to the next Sunday (or stay on it), then back six days
+    return func.date(expression, "weekday 0", "-6 days")
+
+
+def _as_date(value):
+    # SQLite returns week starts as "YYYY-MM-DD" strings
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+class Rollup:
+    """Weekly totals of one table, grouped by one dimension.
+
+    ``time`` is the column (or expression) that puts a row in a week,
+    ``dimensions`` are grouped on in SQL and turned into a label by
+    ``label``, and ``measures`` maps rollup columns to SQL aggregates.
+    ``changed`` returns a select of ids of existing rows whose measures were
+    updated since a given time; new rows are found by id.
+    """
+
+    def __init__(self, metric, model, time, dimensions, measures, label=None, changed=None):
+        self.metric = metric
+        self.model = model
+        self.time = time
+        self.dimensions = dimensions
+        self.measures = measures
+        self.label = label or (lambda values: values[0] or "Unknown")
+        self.changed = changed
+
+
+class AnalyticsRollups:
+    """Rollup rows of (metric, week, dimension) -> totals, kept up to date
+    incrementally.
+
+    A refresh only recomputes the weeks touched since the previous one:
+    weeks with new rows (by id high-water mark) and weeks with rows that
+    ``changed``. Each of those weeks is aggregated with one GROUP BY and its
+    rollup rows replaced, so reads are a small indexed scan of the rollup
+    table however large the source tables grow.
+    """
+
+    def __init__(self, app, db, rollup_model, state_model, rollups, refresh_seconds=60):
+        self.app = app
+        self.db = db
+        self.rollup_table = rollup_model.__table__
+        self.state_table = state_model.__table__
+        self.rollups = {rollup.metric: rollup for rollup in rollups}
+        self.refresh_seconds = refresh_seconds
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh_one(self, conn, rollup, rebuild):
+        State, Rollups = self.state_table, self.rollup_table
+        model_id = rollup.model.id
+        state = conn.execute(select(State).where(State.c.metric == rollup.metric)).first()
+        if state is None:
+            rebuild = True
+        started = datetime.now()
+        max_id = conn.execute(select(func.max(model_id))).scalar() or 0
+        week = week_start(rollup.time, conn.dialect.name)
+
+        weeks = None  # All of them
+        if not rebuild:
+            new = select(week).where(model_id > state.last_id, model_id <= max_id).distinct()
+            weeks = {_as_date(value) for value in conn.execute(new).scalars()}
+            # Rows from transactions still open at the last refresh got ids below the
+            # high-water mark; they most likely fall in that refresh's week, so redo it
+            last = state.refreshed_at.date()
+            weeks.add(last - timedelta(days=last.weekday()))
+            if rollup.changed is not None and state.refreshed_at is not None:
+                changed = select(week).where(model_id.in_(rollup.changed(state.refreshed_at))).distinct()
+                weeks |= {_as_date(value) for value in conn.execute(changed).scalars()}
+
+        if weeks is None or weeks:
+            query = (select(week, *rollup.dimensions, *rollup.measures.values())
+                     .where(model_id <= max_id)
+                     .group_by(week, *rollup.dimensions))
+            if weeks is not None:
+                # The range lets the time index narrow the scan before the week filter
+                query = query.where(rollup.time >= min(weeks), week.in_(sorted(weeks)))
+            totals = {}
+            for row in conn.execute(query):
+                period, dims, values = row[0], row[1:1 + len(rollup.dimensions)], row[1 + len(rollup.dimensions):]
+                key = (_as_date(period), rollup.label(dims))
+                entry = totals.setdefault(key, dict.fromkeys(rollup.measures, None))
+                for measure, value in zip(rollup.measures, values):
+                    if value is not None:
+                        entry[measure] = (entry[measure] or 0) + value
+
+            stale = delete(Rollups).where(Rollups.c.metric == rollup.metric)
+            if weeks is not None:
+                stale = stale.where(Rollups.c.period_start.in_(sorted(weeks)))
+            conn.execute(stale)
+            if totals:
+                conn.execute(insert(Rollups), [
+                    {"metric": rollup.metric, "period_start": period, "dimension": dimension[:255],
+                     "updated_at": started, **values}
+                    for (period, dimension), values in totals.items()
+                ])
+
+        values = {"last_id": max_id, "refreshed_at": started}
+        if state is None:
+            conn.execute(insert(State).values(metric=rollup.metric, **values))
+        else:
+            conn.execute(update(State).where(State.c.metric == rollup.metric).values(values))
+        return len(weeks) if weeks is not None else None
+
+    def refresh(self, metrics=None, rebuild=False):
+        # {metric: weeks recomputed (None for all)}; {} if another worker is refreshing
+        with self.app.app_context():
+            with self.db.engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    locked = conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"),
+                                          {"key": ANALYTICS_LOCK_KEY}).scalar()
+                    if not locked:
+                        return {}
+                return {metric: self._refresh_one(conn, self.rollups[metric], rebuild)
+                        for metric in (metrics or self.rollups)}
+
+    def maybe_refresh(self):
+        # Refresh at most once per refresh_seconds per process; other threads read the current rollups meanwhile
+        if time.monotonic() - self._checked_at < self.refresh_seconds:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._checked_at >= self.refresh_seconds:
+                self.refresh()
+                self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def summary(self, metric, since, dimension=None):
+        # Rollup rows from the week containing `since` onwards, plus totals per dimension
+        Rollups = self.rollup_table
+        monday = since - timedelta(days=since.weekday())
+        query = (select(Rollups).where(Rollups.c.metric == metric, Rollups.c.period_start >= monday)
+                 .order_by(Rollups.c.period_start, Rollups.c.dimension))
+        if dimension:
+            query = query.where(Rollups.c.dimension == dimension)
+        measures = list(self.rollups[metric].measures)
+        weeks, totals = [], {}
+        with self.db.engine.connect() as conn:
+            state = conn.execute(select(self.state_table.c.refreshed_at)
+                                 .where(self.state_table.c.metric == metric)).scalar()
+            for row in conn.execute(query):
+                entry = {"week": row.period_start.isoformat(), "dimension": row.dimension}
+                total = totals.setdefault(row.dimension, dict.fromkeys(measures, 0))
+                for measure in measures:
+                    value = getattr(row, measure)
+                    entry[measure] = value
+                    total[measure] += value or 0
+                weeks.append(entry)
+        ranked = sorted(totals.items(), key=lambda item: -(item[1].get("quantity") or item[1]["count"]))
+        return {
+            "metric": metric,
+            "from": monday.isoformat(),
+            "refreshed_at": state.isoformat() if state else None,
+            "weeks": weeks,
+            "totals": [dict(dimension=name, **values) for name, values in ranked],
+        }
+
+
+def build_rollups():
+    from app import BiofertilizerListing, Donation, NGORequirement, PredictionJob
+
+    def material(model):
+        return [func.lower(func.trim(model.material_type))]
+
+    def place(values):
+        latitude, longitude = values
+        if latitude is None:
+            return "Unknown"
+        return place_at(latitude, longitude) or f"{latitude:.4f},{longitude:.4f}"
+
+    def nutrients_filled(since):
+        # Donations whose nutrients a prediction job filled in after `since`
+        return select(PredictionJob.donation_id).where(PredictionJob.status == "done",
+                                                       PredictionJob.updated_at >= since)
+
+    return [
+        Rollup("biofertilizer-listings", BiofertilizerListing, BiofertilizerListing.timestamp,
+               material(BiofertilizerListing),
+               {"count": func.count(), "quantity": func.sum(BiofertilizerListing.quantity)}),
+        Rollup("ngo-requirements", NGORequirement, NGORequirement.timestamp, material(NGORequirement),
+               {"count": func.count(), "quantity": func.sum(NGORequirement.quantity)}),
+        # Donations made before created_at existed fall in the week of their expiry
+        Rollup("donations", Donation, func.coalesce(Donation.created_at, Donation.expiry),
+               [Donation.latitude, Donation.longitude],
+               {"count": func.count(), "quantity": func.sum(Donation.quantity_value),
+                "calories_kcal": func.sum(Donation.calories_kcal), "protein_g": func.sum(Donation.protein_g),
+                "carbs_g": func.sum(Donation.carbs_g), "fats_g": func.sum(Donation.fats_g)},
+               label=place, changed=nutrients_filled),
+    ]
+
+
+def analytics_from_env(app, db, rollup_model, state_model):
+    return AnalyticsRollups(app, db, rollup_model, state_model, build_rollups(),
+                            refresh_seconds=float(os.environ.get("ANALYTICS_REFRESH_SECONDS", 60)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the analytics rollup tables")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every week instead of the changed ones")
+    parser.add_argument("metrics", nargs="*", help="metrics to refresh (default: all)")
+    args = parser.parse_args()
+
+    from app import analytics
+
+    started = time.perf_counter()
+    result = analytics.refresh(args.metrics or None, rebuild=args.rebuild)
+    print(json.dumps({"weeks_recomputed": result, "seconds": round(time.perf_counter() - started, 3)}, indent=2))
@@ -0,0 +1,98 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue is full and the caller should back off."""
+
+
+class BatchInferenceEngine:
+    """Collects single inference requests and runs them as one batch.
+
+    Callers submit one item at a time and get a Future back. A background
+    worker drains the queue and calls ``batch_fn`` with up to
+    ``max_batch_size`` items, or with whatever arrived once ``max_delay_ms``
+    has passed since the first item of the batch was picked up.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_delay_ms=5, max_queue_size=64, submit_timeout=0.5):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self.submit_timeout = submit_timeout
+        self.max_queue_size = max_queue_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._worker = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def submit(self, item):
+        self._ensure_worker()
+        future = Future()
+        try:
+            # Block for a short while only, so a full queue pushes back on the caller
+            self._queue.put((item, future), timeout=self.submit_timeout)
+        except queue.Full:
+            raise QueueFullError("Inference queue is full")
+        return future
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _after_fork(self):
+        # Threads do not survive fork(); give each worker process its own queue
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                # Started lazily so nothing runs before the process is ready to serve
+                self._worker = threading.Thread(target=self._run, name="batch-inference", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        # Skip futures that were cancelled while waiting in the queue
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self.batch_fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def engine_from_env(batch_fn):
+    # Batch size, deadline and queue depth can be tuned per deployment
+    return BatchInferenceEngine(
+        batch_fn,
+        max_batch_size=int(os.environ.get("FOOD_BATCH_MAX_SIZE", 8)),
+        max_delay_ms=float(os.environ.get("FOOD_BATCH_MAX_DELAY_MS", 5)),
+        max_queue_size=int(os.environ.get("FOOD_BATCH_QUEUE_SIZE", 64)),
+        submit_timeout=float(os.environ.get("FOOD_BATCH_SUBMIT_TIMEOUT", 0.5)),
+    )
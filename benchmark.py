@@ -0,0 +1,234 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+import food_predictor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Food101Split(Dataset):
+    # Images listed in a Food-101 split manifest ({class: ["class/id", ...]})
+    def __init__(self, manifest, images_dir, limit=None):
+        with open(manifest, "r") as f:
+            split = json.load(f)
+        class_ids = {name: i for i, name in enumerate(food_predictor.get_food_classes())}
+        self.items = [(image_id, class_ids[name]) for name in sorted(split) for image_id in split[name]]
+        if limit:
+            # Spread the limit over all classes instead of taking the first few
+            random.Random(0).shuffle(self.items)
+            self.items = self.items[:limit]
+        self.images_dir = images_dir
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        image_id, label = self.items[index]
+        return food_predictor.load_image(os.path.join(self.images_dir, image_id + ".jpg")), label
+
+
+class SyntheticImages(Dataset):
+    # Random JPEGs of phone-photo size, so decode and resize cost is still measured
+    def __init__(self, count, width=4032, height=3024):
+        self.count = count
+        self.width = width
+        self.height = height
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        rng = random.Random(index)
+        noise = Image.frombytes("RGB", (64, 48), bytes(rng.getrandbits(8) for _ in range(64 * 48 * 3)))
+        buffer = io.BytesIO()
+        noise.resize((self.width, self.height)).save(buffer, "JPEG", quality=90)
+        buffer.seek(0)
+        return food_predictor.load_image(buffer), -1
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS; loader workers are children
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {"self": round(own / 2 ** 20, 1), "children": round(children / 2 ** 20, 1)}
+
+
+def run_direct(dataset, batch_size, workers, warmup):
+    # DataLoader workers decode in parallel; the model runs on whole batches
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers, shuffle=False)
+    runner = food_predictor.get_runner()
+    latencies, correct1, correct5, labelled, images = [], 0, 0, 0, 0
+
+    start = None
+    for i, (batch, labels) in enumerate(loader):
+        if i == warmup:
+            start = time.perf_counter()
+        t0 = time.perf_counter()
+        logits = runner(batch).float()
+        elapsed = time.perf_counter() - t0
+        if i < warmup:
+            continue
+        latencies.append(elapsed * 1000)
+        images += len(batch)
+        known = labels >= 0
+        if known.any():
+            top5 = logits[known].topk(5, dim=1).indices
+            correct1 += (top5[:, 0] == labels[known]).sum().item()
+            correct5 += (top5 == labels[known].unsqueeze(1)).any(1).sum().item()
+            labelled += int(known.sum())
+    total = time.perf_counter() - start if start else 0
+    return images, total, latencies, correct1, correct5, labelled
+
+
+def run_engine(dataset, concurrency, warmup):
+    # Concurrent clients submit single images to the micro-batching engine,
+    # the same way the upload routes do; latency is per request
+    images = [dataset[i] for i in range(len(dataset))]
+    engine = food_predictor.inference_engine
+    for tensor, _ in images[:warmup]:
+        engine.submit(tensor).result()
+
+    latencies, hits = [], {"top1": 0, "top5": 0, "labelled": 0}
+    lock = threading.Lock()
+    pending = list(images[warmup:])
+
+    def client():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                tensor, label = pending.pop()
+            t0 = time.perf_counter()
+            result = engine.submit(tensor).result()
+            elapsed = (time.perf_counter() - t0) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if label >= 0:
+                    hits["labelled"] += 1
+                    hits["top1"] += int(result["class_id"] == label)
+                    names = food_predictor.get_food_classes()
+                    hits["top5"] += int(names[label] in [c["food"] for c in result["top_k"][:5]])
+
+    count = len(pending)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return count, time.perf_counter() - start, latencies, hits["top1"], hits["top5"], hits["labelled"]
+
+
+BENCHMARK_CHECKS = [("images_per_sec", True), ("latency_ms.p95", False), ("top1_accuracy", True)]
+
+
+def compare(report, baseline, tolerance, checks=BENCHMARK_CHECKS, absolute=None):
+    # Returns the metrics that got worse than the baseline by more than `tolerance`.
+    # `checks` are (dotted key, higher is better). Keys ending in a suffix from
+    # `absolute` (rates that start at zero) are compared by absolute difference,
+    # against that suffix's tolerance.
+    regressions = []
+    for key, higher_is_better in checks:
+        current, previous = report, baseline
+        for part in key.split("."):
+            current = current.get(part) if isinstance(current, dict) else None
+            previous = previous.get(part) if isinstance(previous, dict) else None
+        if current is None or previous is None:
+            continue
+        allowed = tolerance
+        suffix = next((suffix for suffix in absolute or {} if key.endswith(suffix)), None)
+        if suffix is not None:
+            change, allowed = current - previous, absolute[suffix]
+        elif previous == 0:
+            continue
+        else:
+            change = (current - previous) / previous
+        if (higher_is_better and change < -allowed) or (not higher_is_better and change > allowed):
+            regressions.append({"metric": key, "baseline": previous, "current": current, "change": round(change, 4)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput, latency and accuracy benchmark for food_predictor")
+    parser.add_argument("--manifest", default=os.path.join(BASE_DIR, "food-101", "meta", "test.json"))
+    parser.add_argument("--images-dir", default=os.path.join(BASE_DIR, "food-101", "images"))
+    parser.add_argument("--synthetic", type=int, metavar="N", help="use N synthetic images instead of the dataset")
+    parser.add_argument("--limit", type=int, help="only use this many images from the manifest")
+    parser.add_argument("--mode", choices=["direct", "engine"], default="direct")
+    parser.add_argument("--batch-size", type=int, default=16, help="DataLoader batch size (direct mode)")
+    parser.add_argument("--workers", type=int, default=2, help="parallel decode workers (direct mode)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (engine mode)")
+    parser.add_argument("--warmup", type=int, default=2, help="batches (direct) or requests (engine) to skip")
+    parser.add_argument("--baseline", help="compare against a previous JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression vs the baseline")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    food_predictor.preload()
+    if args.synthetic:
+        dataset = SyntheticImages(args.synthetic)
+    else:
+        if not os.path.isdir(args.images_dir):
+            parser.error(f"{args.images_dir} not found; download Food-101 or use --synthetic N")
+        dataset = Food101Split(args.manifest, args.images_dir, args.limit)
+
+    if args.mode == "direct":
+        images, seconds, latencies, top1, top5, labelled = run_direct(dataset, args.batch_size, args.workers, args.warmup)
+    else:
+        images, seconds, latencies, top1, top5, labelled = run_engine(dataset, args.concurrency, args.warmup)
+
+    report = {
+        "mode": args.mode,
+        "dataset": "synthetic" if args.synthetic else args.manifest,
+        "backend": food_predictor.load_stats.get("backend"),
+        "batch_size": args.batch_size if args.mode == "direct" else food_predictor.inference_engine.max_batch_size,
+        "workers": args.workers if args.mode == "direct" else args.concurrency,
+        "torch_threads": torch.get_num_threads(),
+        "images": images,
+        "seconds": round(seconds, 3),
+        "images_per_sec": round(images / seconds, 2) if seconds else None,
+        "latency_ms": {p: round(percentile(latencies, int(p[1:])), 2) if latencies else None for p in ("p50", "p95", "p99")},
+        "top1_accuracy": round(top1 / labelled, 4) if labelled else None,
+        "top5_accuracy": round(top5 / labelled, 4) if labelled else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "model_load_seconds": food_predictor.load_stats.get("load_seconds"),
+        "host": {"python": platform.python_version(), "torch": torch.__version__, "cpus": os.cpu_count()},
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        status = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
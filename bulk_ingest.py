@@ -0,0 +1,160 @@
+import csv
+import io
+import json
+import math
+import os
+from datetime import date, datetime
+
+from sqlalchemy import insert
+
+MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", 5000))
+INSERT_CHUNK = 1000  # Rows per executemany call
+
+
+class BulkError(ValueError):
+    # The request as a whole is unusable (bad format, too many rows)
+    pass
+
+
+def _text(value):
+    value = str(value).strip()
+    if not value:
+        raise ValueError("must not be empty")
+    return value
+
+
+def _number(value):
+    # Same rule as the single-row routes: quantities are positive and finite
+    number = float(value)
+    if not (math.isfinite(number) and number > 0):
+        raise ValueError("must be a positive number")
+    return number
+
+
+def _date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+
+
+def _datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).strip())
+
+
+PARSERS = {"text": _text, "number": _number, "date": _date, "datetime": _datetime}
+
+
+class BulkSchema:
+    """How rows of one upload map onto a model.
+
+    ``fields`` are ``(key, column, type, required)``; ``key`` is the name
+    used by the single-row JSON route and by CSV headers. ``derive`` adds
+    computed columns (coordinates, numeric quantities) to a valid row.
+    """
+
+    def __init__(self, model, fields, derive=None, defaults=None):
+        self.model = model
+        self.fields = fields
+        self.derive = derive
+        self.defaults = defaults or {}
+
+    def validate(self, rows):
+        # Column by column: one parser per column over every row, errors collected per row
+        table = self.model.__table__
+        records = [dict(self.defaults) for _ in rows]
+        errors = [[] for _ in rows]
+        for key, column, kind, required in self.fields:
+            parse = PARSERS[kind]
+            max_length = getattr(table.c[column].type, "length", None)
+            for i, raw in enumerate(row.get(key) for row in rows):
+                if raw is None or (isinstance(raw, str) and not raw.strip()):
+                    if required:
+                        errors[i].append({"field": key, "error": "is required"})
+                    continue
+                try:
+                    value = parse(raw)
+                except (TypeError, ValueError) as e:
+                    errors[i].append({"field": key, "error": f"invalid {kind}: {e}"})
+                    continue
+                if max_length and isinstance(value, str) and len(value) > max_length:
+                    errors[i].append({"field": key, "error": f"longer than {max_length} characters"})
+                    continue
+                records[i][column] = value
+        if self.derive:
+            for i, record in enumerate(records):
+                if not errors[i]:
+                    record.update(self.derive(record))
+        return records, errors
+
+
+def read_rows(request):
+    # Dicts from a JSON array, NDJSON or CSV body; rows that fail to parse become {"_error": ...}
+    mimetype = request.mimetype
+    if mimetype == "application/json":
+        try:
+            data = json.loads(request.get_data(cache=False) or b"null")
+        except ValueError as e:
+            raise BulkError(f"Invalid JSON: {e}")
+        if not isinstance(data, list):
+            raise BulkError("Expected a JSON array of objects")
+        rows = [row if isinstance(row, dict) else {"_error": "not an object"} for row in data]
+    elif mimetype in ("application/x-ndjson", "application/jsonl", "application/jsonlines"):
+        rows = []
+        for line in io.TextIOWrapper(request.stream, encoding="utf-8"):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                rows.append(row if isinstance(row, dict) else {"_error": "not an object"})
+            except ValueError as e:
+                rows.append({"_error": f"invalid JSON: {e}"})
+            if len(rows) > MAX_ROWS:
+                break
+    elif mimetype == "text/csv":
+        reader = csv.DictReader(io.TextIOWrapper(request.stream, encoding="utf-8-sig", newline=""))
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) > MAX_ROWS:
+                break
+    else:
+        raise BulkError("Send application/json (array), application/x-ndjson or text/csv")
+    if len(rows) > MAX_ROWS:
+        raise BulkError(f"At most {MAX_ROWS} rows per request")
+    return rows
+
+
+def ingest(db, schema, rows, atomic=False, before_commit=None):
+    """Validate ``rows`` and insert the valid ones in one transaction.
+
+    Returns ``{"received", "inserted", "errors"}`` where each error names its
+    row (0-based, in upload order). With ``atomic`` nothing is inserted if
+    any row is invalid. ``before_commit`` is called with the new primary
+    keys inside the transaction.
+    """
+    parse_errors = [row.pop("_error", None) for row in rows]
+    records, errors = schema.validate(rows)
+    for i, message in enumerate(parse_errors):
+        if message:
+            errors[i] = [{"field": None, "error": message}]
+
+    report = [{"row": i, "errors": row_errors} for i, row_errors in enumerate(errors) if row_errors]
+    valid = [record for record, row_errors in zip(records, errors) if not row_errors]
+    if atomic and report:
+        valid = []
+
+    if valid:
+        model = schema.model
+        try:
+            ids = []
+            for start in range(0, len(valid), INSERT_CHUNK):
+                ids.extend(db.session.scalars(insert(model).returning(model.id), valid[start:start + INSERT_CHUNK]))
+            if before_commit:
+                before_commit(ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return {"received": len(rows), "inserted": len(valid), "errors": report}
@@ -0,0 +1,168 @@
+import logging
+import os
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, text
+
+from instrumentation import get_logger, log_event
+
+log = get_logger("change_feed")
+
+NOTIFY_CHANNEL = "frn_changes"
+
+# First half of the two-int pg_advisory_xact_lock key that orders writers per feed (hashtext(feed) is the second)
+FEED_LOCK_KEY = 420105
+
+
+class ChangeFeed:
+    """Ordered log of inserted/changed rows per feed, for live dashboards.
+
+    Writers call ``record`` before committing and ``published`` after; the
+    events share the writer's transaction, so a reader never sees an event
+    for a row that was rolled back. On Postgres, writers to a feed take a
+    transaction-scoped lock before their events get ids, so ids are handed
+    out in commit order and a reader that has seen an id never misses a
+    lower one committed later (SQLite serializes writers anyway). Events
+    older than ``retention`` are deleted. Readers block in ``wait`` until there
+    are events past their cursor. Waiters in the writer's process are woken
+    at once. Other processes are woken by Postgres NOTIFY where available,
+    and otherwise notice within ``poll_interval`` seconds.
+
+    Each waiting client holds a request thread, so at most ``max_waiters``
+    may wait at once per process; ``acquire_waiter`` says whether another
+    may start.
+    """
+
+    PRUNE_INTERVAL = 3600  # Seconds between deletes of old events, per process
+
+    def __init__(self, app, db, event_model, poll_interval=1.0, max_waiters=2, retention=timedelta(days=1)):
+        self.app = app
+        self.db = db
+        self.event_model = event_model
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self.retention = retention
+        self._pruned_at = time.monotonic()
+        self._after_fork()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._changed = threading.Condition()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self._waiter_slots = threading.BoundedSemaphore(self.max_waiters)
+
+    def acquire_waiter(self):
+        # True if a long poll or stream may start; call release_waiter when it ends
+        return self._waiter_slots.acquire(blocking=False)
+
+    def release_waiter(self):
+        self._waiter_slots.release()
+
+    def record(self, feed, row_ids, op="insert"):
+        # Adds events to the current session; the caller commits right after
+        session = self.db.session
+        postgres = self.db.engine.dialect.name == "postgresql"
+        if postgres:
+            # Held until commit. Taken before the events are flushed, so their ids come after
+            # those of every earlier writer to this feed, all of which have committed.
+            session.execute(text("SELECT pg_advisory_xact_lock(:key, hashtext(:feed))"),
+                            {"key": FEED_LOCK_KEY, "feed": feed})
+        session.add_all([self.event_model(feed=feed, row_id=row_id, op=op) for row_id in row_ids])
+        if postgres:
+            # Delivered by Postgres when (and only if) the transaction commits
+            session.execute(text("SELECT pg_notify(:channel, :feed)"), {"channel": NOTIFY_CHANNEL, "feed": feed})
+
+    def published(self, feed=None):
+        with self._changed:
+            self._changed.notify_all()
+        self._maybe_prune()
+
+    def _maybe_prune(self):
+        if time.monotonic() - self._pruned_at < self.PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        Event = self.event_model
+        try:
+            with self.db.engine.begin() as conn:
+                removed = conn.execute(delete(Event).where(Event.created_at < datetime.now() - self.retention)).rowcount
+        except Exception as e:
+            log_event(log, logging.ERROR, "pruning change events failed", error=str(e))
+            return
+        if removed:
+            log_event(log, logging.INFO, "pruned change events", count=removed)
+
+    def head(self, feed):
+        Event = self.event_model
+        return self.db.session.query(func.max(Event.id)).filter(Event.feed == feed).scalar() or 0
+
+    def cursor_at(self, feed, moment):
+        # Cursor just before the first event at or after `moment`
+        Event = self.event_model
+        first = self.db.session.query(func.min(Event.id)).filter(Event.feed == feed, Event.created_at >= moment).scalar()
+        return first - 1 if first else self.head(feed)
+
+    def events_since(self, feed, since, limit=500):
+        Event = self.event_model
+        return (self.db.session.query(Event)
+                .filter(Event.feed == feed, Event.id > since)
+                .order_by(Event.id).limit(limit).all())
+
+    def wait(self, feed, since, timeout):
+        # Events after `since`, waiting up to `timeout` seconds for the first one
+        self._start_listener()
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.events_since(feed, since)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            # Release the connection while idle so waiters do not drain the pool
+            self.db.session.close()
+            with self._changed:
+                self._changed.wait(min(remaining, self.poll_interval))
+
+    def _start_listener(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self.app.app_context():
+            if self.db.engine.dialect.name != "postgresql":
+                return
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="change-feed-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        # LISTEN on a connection of our own and wake local waiters on every NOTIFY
+        while True:
+            try:
+                with self.app.app_context():
+                    connection = self.db.engine.raw_connection()
+                try:
+                    dbapi = connection.driver_connection
+                    dbapi.autocommit = True
+                    with dbapi.cursor() as cursor:
+                        cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    while True:
+                        if select.select([dbapi], [], [], 30) == ([], [], []):
+                            continue
+                        dbapi.poll()
+                        if dbapi.notifies:
+                            dbapi.notifies.clear()
+                            self.published()
+                finally:
+                    connection.invalidate()  # Do not hand a LISTENing connection back to the pool
+            except Exception as e:
+                log_event(log, logging.ERROR, "change feed listener failed", error=str(e))
+                time.sleep(5)
+
+
+def feed_from_env(app, db, event_model):
+    return ChangeFeed(app, db, event_model, poll_interval=float(os.environ.get("FEED_POLL_SECONDS", 1)),
+                      max_waiters=int(os.environ.get("FEED_MAX_WAITERS", 2)),
+                      retention=timedelta(hours=float(os.environ.get("FEED_RETENTION_HOURS", 24))))
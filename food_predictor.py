@@ -1,33 +1,131 @@
 import torch
 from torchvision import models, transforms
 from PIL import Image
+import io
+import logging
 import os
+import threading
+import time
+from batch_inference import QueueFullError, engine_from_env
+from inference_backends import DEFAULT_BACKEND, calibration_batches, configure_threads, prepare_backend
+from prediction_cache import cache_from_env, content_hash, file_fingerprint
+from nutrition import format_nutrients, load_nutrient_table
+from instrumentation import (INFERENCE_BATCH_SIZE, INFERENCE_QUEUE_DEPTH, PREDICTION_CACHE, get_logger, log_event,
+                             timed)
 
-# Load class labels
-with open("food-101/meta/classes.txt", "r") as f:
-    food_classes = [line.strip() for line in f]
+log = get_logger("predictor")
 
-# Load pretrained model (ImageNet weights)
-model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
-model.fc = torch.nn.Linear(model.fc.in_features, 101)  # 101 classes in Food-101
-model.eval()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CLASSES_PATH = os.path.join(BASE_DIR, "food-101", "meta", "classes.txt")
 
 # Use a relative path to the model file
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "model", "model.pth")
+MODEL_PATH = os.environ.get("FOOD_MODEL_PATH", os.path.join(BASE_DIR, "model", "model.pth"))
+# TorchScript snapshot of the fine-tuned model, written by `python food_predictor.py snapshot`
+SNAPSHOT_PATH = os.environ.get("FOOD_MODEL_SNAPSHOT", os.path.join(BASE_DIR, "model", "model.ts"))
 
-# Load the model
-model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu'), weights_only=True))
+# Nothing is loaded at import time; the first prediction (or preload()) does it
+_model = None
+_runner = None
+_food_classes = None
+_nutrient_table = None
+_load_lock = threading.Lock()
+_runner_lock = threading.Lock()
+load_stats = {}
 
-# Define some sample nutrient data (you can expand this)
-sample_nutrients = {
-    "pizza": {"Calories": "266 kcal", "Protein": "11 g", "Carbs": "33 g", "Fats": "10 g"},
-    "samosa": {"Calories": "262 kcal", "Protein": "6 g", "Carbs": "30 g", "Fats": "15 g"},
-    "ice_cream": {"Calories": "207 kcal", "Protein": "3.5 g", "Carbs": "24 g", "Fats": "11 g"},
-    "chicken_curry": {"Calories": "438 kcal", "Protein": "30 g", "Carbs": "15 g", "Fats": "30 g"},
-    "fried_rice": {"Calories": "343 kcal", "Protein": "14 g", "Carbs": "55 g", "Fats": "7 g"},
-    "apple_pie": {"Calories": "411 kcal", "Protein": "4 g", "Carbs": "58 g", "Fats": "19.4 g"},
-}
+def get_food_classes():
+    global _food_classes
+    if _food_classes is None:
+        with _load_lock:
+            if _food_classes is None:
+                # Load class labels
+                with open(CLASSES_PATH, "r") as f:
+                    _food_classes = [line.strip() for line in f]
+    return _food_classes
 
+def get_nutrient_table():
+    # (101, 4) tensor of calories/protein/carbs/fats per class id, from food-101/meta/nutrients.csv
+    global _nutrient_table
+    if _nutrient_table is None:
+        table = torch.tensor(load_nutrient_table(get_food_classes()), dtype=torch.float32)
+        _nutrient_table = table
+    return _nutrient_table
+
+def _snapshot_is_fresh():
+    # A snapshot older than the checkpoint was taken from a previous model
+    if not os.path.exists(SNAPSHOT_PATH):
+        return False
+    if not os.path.exists(MODEL_PATH):
+        return True
+    return os.path.getmtime(SNAPSHOT_PATH) >= os.path.getmtime(MODEL_PATH)
+
+def build_model():
+    # Only the architecture is needed: the fine-tuned state dict replaces every
+    # weight, so downloading the ImageNet weights first is wasted work
+    model = models.resnet50(weights=None)
+    model.fc = torch.nn.Linear(model.fc.in_features, 101)  # 101 classes in Food-101
+    model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu'), weights_only=True))
+    model.eval()
+    return model
+
+def get_model():
+    global _model
+    if _model is None:
+        with _load_lock:
+            if _model is None:
+                start = time.perf_counter()
+                if _snapshot_is_fresh():
+                    model = torch.jit.load(SNAPSHOT_PATH, map_location=torch.device('cpu'))
+                    source = "snapshot"
+                else:
+                    model = build_model()
+                    source = "checkpoint"
+                model.eval()
+                load_stats["source"] = source
+                load_stats["load_seconds"] = time.perf_counter() - start
+                log_event(log, logging.INFO, "model loaded", source=source, load_seconds=round(load_stats['load_seconds'], 3))
+                _model = model
+    return _model
+
+def get_runner():
+    # The callable used for inference, built for FOOD_INFERENCE_BACKEND. Its own
+    # lock, since building it takes _load_lock through get_model
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                configure_threads()
+                if DEFAULT_BACKEND == "fp32":
+                    runner = prepare_backend("fp32", get_model())
+                else:
+                    # Quantization, compilation and export all need the eager module
+                    start = time.perf_counter()
+                    calibration = calibration_batches() if DEFAULT_BACKEND == "int8_static" else None
+                    runner = prepare_backend(DEFAULT_BACKEND, build_model(), calibration)
+                    load_stats["backend_seconds"] = time.perf_counter() - start
+                load_stats["backend"] = DEFAULT_BACKEND
+                _runner = runner
+    return _runner
+
+def preload():
+    # Call from the master process before forking workers so they share the
+    # model weights copy-on-write instead of each loading their own
+    get_food_classes()
+    get_nutrient_table()
+    get_runner()
+
+def save_snapshot(path=SNAPSHOT_PATH):
+    # Trace the fine-tuned model once; loading the traced file skips building
+    # the Python module tree and is much faster on cold start
+    model = build_model()
+    example = torch.zeros(1, 3, 224, 224)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    traced.save(path)
+    return path
+
+# Nutrient values for every class live in food-101/meta/nutrients.csv;
+# these are only used when the prediction itself fails
 default_nutrients = {"Calories": "300 kcal", "Protein": "10 g", "Carbs": "40 g", "Fats": "12 g"}
 
 # Image transform
@@ -38,30 +136,125 @@ transform = transforms.Compose([
                          std=[0.229, 0.224, 0.225])
 ])
 
+def load_image(source):
+    # Decode and transform a single image (path or file object) into a (3, 224, 224) tensor
+    with timed("decode"):
+        image = Image.open(source)
+        # For JPEGs, let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding as long
+        # as the result stays at least 224x224; a no-op for other formats
+        image.draft('RGB', (224, 224))
+        image = image.convert('RGB')
+    with timed("transform"):
+        return transform(image)
+
+# Number of candidate classes returned with each prediction
+TOP_K = int(os.environ.get("FOOD_TOP_K", 5))
+
+def predict_batch(images):
+    # Run one forward pass over a list of image tensors. Softmax, top-k and the
+    # probability-weighted nutrient estimate are computed for the whole batch at once.
+    runner = get_runner()
+    food_classes = get_food_classes()
+    table = get_nutrient_table()
+
+    INFERENCE_BATCH_SIZE.observe(len(images))
+    with timed("forward"):
+        logits = runner(torch.stack(images)).float()
+    with timed("postprocess"):
+        probs = torch.softmax(logits, dim=1)
+        top_probs, top_idx = probs.topk(min(TOP_K, probs.shape[1]), dim=1)
+        estimates = probs @ table  # (N, 101) x (101, 4) -> (N, 4)
+
+        results = []
+        for row_probs, row_idx, estimate in zip(top_probs.tolist(), top_idx.tolist(), estimates.tolist()):
+            results.append({
+                "class_id": row_idx[0],
+                "food": food_classes[row_idx[0]].lower().replace(" ", "_"),  # Normalize food name
+                "top_k": [
+                    {"food": food_classes[idx].lower().replace(" ", "_"), "probability": round(p, 4)}
+                    for idx, p in zip(row_idx, row_probs)
+                ],
+                "estimated_nutrients": format_nutrients(estimate),
+            })
+    return results
+
+# Requests from concurrent uploads are gathered here and run as one batch
+inference_engine = engine_from_env(predict_batch)
+RESULT_TIMEOUT = float(os.environ.get("FOOD_BATCH_RESULT_TIMEOUT", 30))
+
+# The same photo is usually predicted twice (preview, then form submit)
+prediction_cache = cache_from_env()
+# Bump when the shape of cached prediction results changes
+PREDICTION_FORMAT = "v2"
+
+def model_version():
+    # Changes whenever the checkpoint or backend is replaced, which retires old cache keys
+    checkpoint = MODEL_PATH if os.path.exists(MODEL_PATH) else SNAPSHOT_PATH
+    return f"{PREDICTION_FORMAT}-{DEFAULT_BACKEND}-{file_fingerprint(checkpoint)}"
+
 def predict_nutrients(filepath):
-    try:
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    return predict_nutrients_from_bytes(data)
+
+def predict_food(data):
+    # Full prediction for one image: top class, top-k candidates with
+    # probabilities and the probability-weighted nutrient estimate
+    cache_key = f"{content_hash(data)}-{model_version()}"
+    result = prediction_cache.get(cache_key)
+    PREDICTION_CACHE.labels("hit" if result is not None else "miss").inc()
+    if result is None:
         # Load the image
-        image = Image.open(filepath).convert('RGB')
-        image = transform(image).unsqueeze(0)  # Add batch dimension
+        image = load_image(io.BytesIO(data))
 
-        # Perform inference
-        with torch.no_grad():
-            outputs = model(image)
-            _, predicted_idx = outputs.max(1)
-            food_name = food_classes[predicted_idx.item()].lower().replace(" ", "_")  # Normalize food name
+        # Perform inference (batched with other pending requests)
+        future = inference_engine.submit(image)
+        INFERENCE_QUEUE_DEPTH.set(inference_engine.qsize())
+        result = future.result(timeout=RESULT_TIMEOUT)
+        INFERENCE_QUEUE_DEPTH.set(inference_engine.qsize())
+        prediction_cache.set(cache_key, result)
+    return result
 
-        # Debugging
-        print(f"Predicted food name: {food_name}")
+def predict_food_nutrients(data):
+    # predict_food's result plus `nutrients`, those of the top class; raises if
+    # the prediction fails, so prediction jobs can retry instead of storing
+    # made-up values
+    result = predict_food(data)
+    return dict(result, nutrients=format_nutrients(get_nutrient_table()[result["class_id"]].tolist()))
 
-        # Get nutrient data
-        nutrients = sample_nutrients.get(food_name, default_nutrients)
-        if nutrients == default_nutrients:
-            print("Using default nutrients.")
-        else:
-            print("Nutrient data found!")
+def predict_nutrients_from_bytes(data):
+    # For the upload preview, where default values beat an error page
+    try:
+        return predict_food_nutrients(data)
+    except QueueFullError:
+        # Let the caller turn this into a 503 instead of a fake prediction
+        raise
+    except Exception as e:
+        log.exception("prediction failed", extra={"fields": {"error": str(e)}})
+        return {"food": "Unknown", "nutrients": default_nutrients, "top_k": [], "estimated_nutrients": None}
 
-        return food_name, nutrients
 
-    except Exception as e:
-        print(f"Error in predict_nutrients: {e}")
-        return "Unknown", default_nutrients
+def _measure_startup():
+    # Time a cold load from the checkpoint and, if present, from the snapshot
+    results = {}
+    start = time.perf_counter()
+    build_model()
+    results["checkpoint_seconds"] = time.perf_counter() - start
+    if os.path.exists(SNAPSHOT_PATH):
+        start = time.perf_counter()
+        torch.jit.load(SNAPSHOT_PATH, map_location=torch.device('cpu'))
+        results["snapshot_seconds"] = time.perf_counter() - start
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Food model utilities")
+    parser.add_argument("command", choices=["snapshot", "startup-time"])
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        print(f"Snapshot written to {save_snapshot()}")
+    else:
+        print(json.dumps(_measure_startup(), indent=2))
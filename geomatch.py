@@ -0,0 +1,175 @@
+import csv
+import math
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH", os.path.join(BASE_DIR, "geo", "gazetteer.csv"))
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+MAX_NAME_WORDS = 3  # Longest place name in the gazetteer, in words
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def _normalize(text):
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+def get_gazetteer():
+    # {normalized name: (kind, latitude, longitude)}, loaded on first use
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                with open(GAZETTEER_PATH, "r", newline="") as f:
+                    _gazetteer = {
+                        _normalize(row["name"]): (row["kind"], float(row["latitude"]), float(row["longitude"]))
+                        for row in csv.DictReader(f)
+                    }
+    return _gazetteer
+
+
+_place_names = None
+
+
+def place_at(lat, lon):
+    # Name of the gazetteer place at exactly these coordinates, e.g. from geocode();
+    # for places listed under several names, the first one
+    global _place_names
+    if _place_names is None:
+        names = {}
+        for name, (_, place_lat, place_lon) in get_gazetteer().items():
+            names.setdefault((place_lat, place_lon), name.title())
+        _place_names = names
+    return _place_names.get((lat, lon))
+
+
+@lru_cache(maxsize=4096)
+def geocode(location):
+    # (latitude, longitude) of the most specific known place named in a free-text
+    # location, e.g. "12 MG Road, Indiranagar, Bangalore" -> Indiranagar; None if none is known
+    if not location:
+        return None
+    gazetteer = get_gazetteer()
+    words = _normalize(location).split()
+    best, best_rank = None, None
+    for n in range(min(MAX_NAME_WORDS, len(words)), 0, -1):
+        for i in range(len(words) - n + 1):
+            place = gazetteer.get(" ".join(words[i:i + n]))
+            if place is None:
+                continue
+            # Localities beat cities, then longer names beat shorter ones
+            rank = (place[0] == "locality", n)
+            if best_rank is None or rank > best_rank:
+                best, best_rank = place, rank
+    return (best[1], best[2]) if best else None
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """Points bucketed into square lat/lon cells about ``cell_km`` wide.
+
+    A radius query only visits the cells overlapping the circle's bounding
+    box, so its cost depends on how many points are nearby rather than on
+    the total number of points.
+    """
+
+    def __init__(self, cell_km=10):
+        self.cell_deg = cell_km / KM_PER_DEGREE
+        self.cells = {}
+        self.size = 0
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def insert(self, lat, lon, item):
+        self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+        self.size += 1
+
+    def query(self, lat, lon, radius_km, predicate=None):
+        # [(distance_km, item)] within radius_km, nearest first
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        row_min, col_min = self._cell(lat - dlat, lon - dlon)
+        row_max, col_max = self._cell(lat + dlat, lon + dlon)
+        found = []
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                for point_lat, point_lon, item in self.cells.get((row, col), ()):
+                    distance = haversine_km(lat, lon, point_lat, point_lon)
+                    if distance <= radius_km and (predicate is None or predicate(item)):
+                        found.append((distance, item))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class MatchService:
+    """In-memory spatial indexes over geocoded rows, one per kind of row.
+
+    Each kind has a loader returning ``(latitude, longitude, item)`` tuples for
+    the rows that can currently be matched. An index is rebuilt from its
+    loader when a write in this process invalidates it, or once it is older
+    than ``ttl_seconds`` (which bounds staleness for writes made by other
+    workers).
+    """
+
+    def __init__(self, ttl_seconds=60, cell_km=10):
+        self.ttl_seconds = ttl_seconds
+        self.cell_km = cell_km
+        self._loaders = {}
+        self._indexes = {}  # kind -> (built_at, generation, GridIndex)
+        self._generations = {}
+        self._locks = {}
+
+    def register(self, kind, loader):
+        self._loaders[kind] = loader
+        self._generations[kind] = 0
+        self._locks[kind] = threading.Lock()
+
+    def invalidate(self, kind):
+        # Bumping the generation also discards a rebuild that was already loading
+        self._generations[kind] += 1
+
+    def _fresh(self, kind, entry):
+        return (entry is not None and entry[1] == self._generations[kind]
+                and time.time() - entry[0] <= self.ttl_seconds)
+
+    def index(self, kind):
+        entry = self._indexes.get(kind)
+        if not self._fresh(kind, entry):
+            with self._locks[kind]:
+                # Another thread may have rebuilt it while we waited
+                entry = self._indexes.get(kind)
+                if not self._fresh(kind, entry):
+                    generation = self._generations[kind]
+                    grid = GridIndex(self.cell_km)
+                    for lat, lon, item in self._loaders[kind]():
+                        grid.insert(lat, lon, item)
+                    entry = (time.time(), generation, grid)
+                    self._indexes[kind] = entry
+        return entry[2]
+
+    def nearest(self, kinds, lat, lon, radius_km, predicate=None, limit=10):
+        found = []
+        for kind in kinds:
+            found.extend(self.index(kind).query(lat, lon, radius_km, predicate))
+        found.sort(key=lambda pair: pair[0])
+        return [dict(item, distance_km=round(distance, 2)) for distance, item in found[:limit]]
+
+
+def service_from_env():
+    return MatchService(
+        ttl_seconds=float(os.environ.get("MATCH_INDEX_TTL", 60)),
+        cell_km=float(os.environ.get("MATCH_CELL_KM", 10)),
+    )
@@ -0,0 +1,93 @@
+# Production serving config: gunicorn -c gunicorn.conf.py app:app
+#
+# SERVER_ROLE picks the worker layout:
+#   web        gthread workers with many threads, for the page, listing and
+#              auth routes that mostly wait on Postgres (default)
+#   inference  fewer gthread workers with a few threads each and more torch
+#              threads, for a separate service that takes /upload-image and
+#              /api/create-donation (plus prediction jobs). Threads, not sync
+#              workers: the batching engine can only batch requests that are
+#              in flight in the same process at once. With
+#              FOOD_BATCH_MAX_SIZE=1, GUNICORN_WORKER_CLASS=sync is an option.
+import os
+
+role = os.environ.get("SERVER_ROLE", "web")
+cpus = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Import the app (and the model, see when_ready) once in the master; workers
+# are forked from it and share the weights copy-on-write
+preload_app = True
+
+if role == "inference":
+    workers = int(os.environ.get("WEB_CONCURRENCY", max(1, cpus // 2)))
+    worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))  # Requests wait on the batching engine, not the CPU
+    timeout = 60
+else:
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2 * cpus + 1))
+    worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+    threads = int(os.environ.get("GUNICORN_THREADS", 8))
+    timeout = 30
+
+# Let in-flight requests finish on SIGTERM/HUP before workers are replaced
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then to cap slow memory growth
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+# Metric files from a previous run would be summed into this one. Cleared
+# here because the config is read before preload_app imports the app.
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    import shutil
+
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any worker is
+    # forked. With the default fp32 backend only weights are loaded, with no
+    # forward pass, so no torch thread pool exists yet when workers fork.
+    import gc
+
+    import food_predictor
+
+    if os.environ.get("PRELOAD_MODEL", "1") == "1":
+        food_predictor.preload()
+        server.log.info("Food model preloaded in master (%s)", food_predictor.load_stats)
+    # Keep the garbage collector from touching (and so copying) the
+    # master's objects in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    from app import app, dp
+
+    # Connections opened in the master (migrations) must not be shared
+    with app.app_context():
+        dp.engine.dispose(close=False)
+
+    # Split the cores between workers so intra-op threads do not oversubscribe
+    threads = os.environ.get("FOOD_TORCH_THREADS")
+    torch_threads = int(threads) if threads else max(1, cpus // server.cfg.workers)
+    torch.set_num_threads(torch_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Already set in this process
+    server.log.info("Worker %s using %s torch threads", worker.pid, torch_threads)
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges (queue depth) from /metrics
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
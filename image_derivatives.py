@@ -0,0 +1,93 @@
+import io
+import os
+import threading
+
+from PIL import Image, features
+
+from prediction_cache import content_hash
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DERIVED_FOLDER = os.path.join(BASE_DIR, "static", "derived")
+
+# Longest edge in pixels for each rendition
+RENDITIONS = {"thumb": 320, "medium": 960}
+IMAGE_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+EXTENSION = "webp" if IMAGE_FORMAT == "WEBP" else "jpg"
+MIMETYPE = "image/webp" if IMAGE_FORMAT == "WEBP" else "image/jpeg"
+QUALITY = int(os.environ.get("DERIVATIVE_QUALITY", 80))
+
+# Derived files never change for a given name, so browsers may keep them for a year
+CACHE_MAX_AGE = 365 * 24 * 3600
+DIGEST_LENGTH = 32
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def data_digest(data):
+    return content_hash(data)[:DIGEST_LENGTH]
+
+
+def derivative_filename(digest, rendition):
+    return f"{digest[:DIGEST_LENGTH]}-{rendition}.{EXTENSION}"
+
+
+def render(data, rendition):
+    size = RENDITIONS[rendition]
+    image = Image.open(io.BytesIO(data))
+    # Let the JPEG decoder do most of the downscaling
+    image.draft("RGB", (size, size))
+    image = image.convert("RGB")
+    image.thumbnail((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, IMAGE_FORMAT, quality=QUALITY)
+    return out.getvalue()
+
+
+def ensure_derivative(data, rendition, digest=None):
+    digest = digest or content_hash(data)
+    name = derivative_filename(digest, rendition)
+    path = os.path.join(DERIVED_FOLDER, name)
+    if not os.path.exists(path):
+        os.makedirs(DERIVED_FOLDER, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(render(data, rendition))
+        os.replace(tmp_path, path)
+    return name
+
+
+def create_derivatives(data, digest=None):
+    # Called at upload time so listings never wait for a resize
+    digest = digest or content_hash(data)
+    return {rendition: ensure_derivative(data, rendition, digest) for rendition in RENDITIONS}
+
+
+def source_digest(path):
+    # Hash each original once per process; keyed on size+mtime so a replaced file is rehashed
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    digest = _digests.get(key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = data_digest(f.read())
+        with _digests_lock:
+            if len(_digests) > 10000:
+                _digests.clear()
+            _digests[key] = digest
+    return digest
+
+
+def derivative_urls(image_path, digest):
+    # URLs embed the content hash (stored with the row when the image is
+    # uploaded), so they can be cached forever and change with the image
+    if digest is None:
+        return {"thumbnail_url": None, "medium_url": None}
+    filename = os.path.basename(image_path)
+    return {
+        "thumbnail_url": f"/media/thumb/{digest}/{filename}",
+        "medium_url": f"/media/medium/{digest}/{filename}",
+    }
@@ -0,0 +1,212 @@
+import logging
+import os
+import time
+
+import torch
+
+from instrumentation import get_logger, log_event
+
+log = get_logger("inference_backends")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ONNX_PATH = os.environ.get("FOOD_ONNX_PATH", os.path.join(BASE_DIR, "model", "model.onnx"))
+EXAMPLE_SHAPE = (1, 3, 224, 224)
+# Real food photos for int8_static calibration, e.g. a copy of a sample of static/uploads
+CALIBRATION_DIR = os.environ.get("FOOD_CALIBRATION_DIR")
+CALIBRATION_IMAGES = int(os.environ.get("FOOD_CALIBRATION_IMAGES", 64))
+
+
+# Each backend takes the eager fp32 model and returns a callable that maps a
+# (N, 3, 224, 224) float tensor to a (N, 101) tensor of logits.
+
+def _fp32(model, calibration=None):
+    model.eval()
+
+    def run(batch):
+        with torch.inference_mode():
+            return model(batch)
+    return run
+
+def _channels_last(model, calibration=None):
+    # NHWC lets the oneDNN convolution kernels skip layout reorders on CPU
+    model = model.eval().to(memory_format=torch.channels_last)
+
+    def run(batch):
+        with torch.inference_mode():
+            return model(batch.contiguous(memory_format=torch.channels_last))
+    return run
+
+def _int8_dynamic(model, calibration=None):
+    # Dynamic quantization only covers Linear layers, i.e. the final fc of ResNet-50
+    quantized = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    return _fp32(quantized)
+
+def _int8_static(model, calibration=None):
+    # Post-training static quantization of the whole network (FX graph mode).
+    # Activation ranges come from the calibration batches, so they must be real
+    # images: ranges seen on random noise make the model's accuracy unusable.
+    if not calibration:
+        raise ValueError("int8_static needs calibration images; set FOOD_CALIBRATION_DIR to a directory of food photos")
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    model = model.eval()
+    example = torch.zeros(EXAMPLE_SHAPE)
+    prepared = prepare_fx(model, get_default_qconfig_mapping("x86"), (example,))
+    with torch.inference_mode():
+        for batch in calibration:
+            prepared(batch)
+    log_event(log, logging.INFO, "int8_static calibrated", images=sum(len(batch) for batch in calibration))
+    return _fp32(convert_fx(prepared))
+
+def _torchscript(model, calibration=None):
+    with torch.inference_mode():
+        traced = torch.jit.trace(model.eval(), torch.zeros(EXAMPLE_SHAPE))
+    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    return _fp32(traced)
+
+def _compile(model, calibration=None):
+    return _fp32(torch.compile(model.eval()))
+
+def _onnx(model, calibration=None):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("The onnx backend requires the onnxruntime package")
+
+    if not os.path.exists(ONNX_PATH):
+        export_onnx(model, ONNX_PATH)
+    session = onnxruntime.InferenceSession(ONNX_PATH, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    def run(batch):
+        outputs = session.run(None, {input_name: batch.numpy()})
+        return torch.from_numpy(outputs[0])
+    return run
+
+BACKENDS = {
+    "fp32": _fp32,
+    "channels_last": _channels_last,
+    "int8_dynamic": _int8_dynamic,
+    "int8_static": _int8_static,
+    "torchscript": _torchscript,
+    "compile": _compile,
+    "onnx": _onnx,
+}
+
+DEFAULT_BACKEND = os.environ.get("FOOD_INFERENCE_BACKEND", "fp32")
+
+
+def export_onnx(model, path=ONNX_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(
+        model.eval(), torch.zeros(EXAMPLE_SHAPE), path,
+        input_names=["images"], output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+    )
+    return path
+
+def configure_threads():
+    # On a shared CPU box the default (one thread per core) oversubscribes
+    # as soon as there is more than one worker process
+    threads = os.environ.get("FOOD_TORCH_THREADS")
+    if threads:
+        torch.set_num_threads(int(threads))
+
+def calibration_batches(directory=CALIBRATION_DIR, limit=CALIBRATION_IMAGES, batch_size=8):
+    # Up to `limit` images from `directory` as (N, 3, 224, 224) batches; [] without a directory
+    from food_predictor import load_image
+
+    if not directory:
+        return []
+    names = sorted(name for name in os.listdir(directory)
+                   if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))[:limit]
+    images = [load_image(os.path.join(directory, name)) for name in names]
+    return [torch.stack(images[start:start + batch_size]) for start in range(0, len(images), batch_size)]
+
+def prepare_backend(name, model, calibration=None):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}; choose one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](model, calibration)
+
+
+def held_out_slice(test_json, per_class):
+    # Deterministic slice of the Food-101 test split: the first `per_class`
+    # images of every class, in sorted order. Labels are the model's class
+    # ids, i.e. the order of classes.txt, which is not sorted order
+    import json
+
+    from food_predictor import get_food_classes
+
+    class_ids = {name: i for i, name in enumerate(get_food_classes())}
+    with open(test_json, "r") as f:
+        split = json.load(f)
+    items = []
+    for class_name in sorted(split):
+        for image_id in sorted(split[class_name])[:per_class]:
+            items.append((image_id, class_ids[class_name]))
+    return items
+
+def _load_batches(items, images_dir, batch_size):
+    from PIL import Image
+
+    from food_predictor import transform
+
+    for start in range(0, len(items), batch_size):
+        chunk = items[start:start + batch_size]
+        images = [transform(Image.open(os.path.join(images_dir, image_id + ".jpg")).convert("RGB")) for image_id, _ in chunk]
+        yield torch.stack(images), torch.tensor([label for _, label in chunk])
+
+def check_accuracy(backend_names, images_dir, test_json, train_json, per_class=5, batch_size=16):
+    # Compare each backend against the fp32 reference on the same images.
+    # int8_static is calibrated on one image per class of the train split, so
+    # it never sees the images it is scored on
+    from food_predictor import build_model
+
+    items = held_out_slice(test_json, per_class)
+    batches = list(_load_batches(items, images_dir, batch_size))
+    calibration = None
+    if "int8_static" in backend_names:
+        calibration = [images for images, _ in _load_batches(held_out_slice(train_json, 1), images_dir, batch_size)]
+    reference = _fp32(build_model())
+    ref_logits = [reference(images) for images, _ in batches]
+    labels = torch.cat([batch_labels for _, batch_labels in batches])
+
+    report = {"images": len(items), "backends": {}}
+    for name in ["fp32"] + [b for b in backend_names if b != "fp32"]:
+        runner = reference if name == "fp32" else prepare_backend(name, build_model(), calibration=calibration)
+        runner(batches[0][0])  # Warm up (tracing, compilation, allocator)
+        start = time.perf_counter()
+        logits = [runner(images).float() for images, _ in batches]
+        elapsed = time.perf_counter() - start
+        logits = torch.cat(logits)
+        reference_all = torch.cat(ref_logits)
+        top1 = logits.argmax(1)
+        top5 = logits.topk(5, dim=1).indices
+        report["backends"][name] = {
+            "top1_accuracy": (top1 == labels).float().mean().item(),
+            "top5_accuracy": (top5 == labels.unsqueeze(1)).any(1).float().mean().item(),
+            "top1_agreement_with_fp32": (top1 == reference_all.argmax(1)).float().mean().item(),
+            "max_abs_logit_diff": (logits - reference_all).abs().max().item(),
+            "ms_per_image": elapsed * 1000 / len(items),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Check inference backends against the fp32 model")
+    parser.add_argument("backends", nargs="+", choices=list(BACKENDS))
+    parser.add_argument("--images-dir", default=os.path.join(BASE_DIR, "food-101", "images"))
+    parser.add_argument("--test-json", default=os.path.join(BASE_DIR, "food-101", "meta", "test.json"))
+    parser.add_argument("--train-json", default=os.path.join(BASE_DIR, "food-101", "meta", "train.json"),
+                        help="split whose images calibrate int8_static")
+    parser.add_argument("--per-class", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    configure_threads()
+    print(json.dumps(check_accuracy(args.backends, args.images_dir, args.test_json, args.train_json, args.per_class,
+                                    args.batch_size), indent=2))
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+# Under gunicorn, set PROMETHEUS_MULTIPROC_DIR so /metrics adds up every worker
+# instead of reporting whichever worker answered the scrape
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+SLOW_REQUEST_MS = float(os.environ.get("LOG_SLOW_REQUEST_MS", 500))
+LOG_REQUESTS = os.environ.get("LOG_REQUESTS", "0") == "1"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route",
+    ["method", "route", "status"],
+)
+DB_QUERIES = Histogram(
+    "db_queries_per_request", "SQL statements executed per request",
+    ["route"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "SQL statement latency",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+INFERENCE_STAGE = Histogram(
+    "inference_stage_seconds", "Time per inference stage (decode, transform, forward, postprocess)",
+    ["stage"], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    "inference_batch_size", "Images per forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+PREDICTION_CACHE = Counter("prediction_cache_lookups_total", "Prediction cache lookups", ["result"])
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "inference_queue_depth", "Images waiting for the batching engine",
+    multiprocess_mode="livesum",
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_seconds", "Time to hash or verify one password",
+    ["op"], buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+PASSWORD_HASH_QUEUE = Gauge(
+    "password_hash_queue_depth", "Password hashes running or waiting",
+    multiprocess_mode="livesum",
+)
+AUTH_RATE_LIMITED = Counter("auth_rate_limited_total", "Login and signup attempts refused by a rate limit", ["limit"])
+SESSION_LOOKUPS = Counter(
+    "session_lookups_total", "Session lookups by where they were answered (local, shared, miss)", ["source"],
+)
+PREDICTION_JOBS = Gauge(
+    "prediction_jobs", "Prediction jobs by status",
+    ["status"], multiprocess_mode="livemostrecent",
+)
+
+
+@contextmanager
+def timed(stage):
+    # with timed("decode"): ... records into inference_stage_seconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        INFERENCE_STAGE.labels(stage).observe(time.perf_counter() - start)
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line; fields passed as extra={"fields": {...}} are merged in
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name):
+    logger = logging.getLogger(f"frn.{name}")
+    root = logging.getLogger("frn")
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JSONFormatter())
+        root.addHandler(handler)
+        root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+    return logger
+
+
+def log_event(logger, level, message, **fields):
+    logger.log(level, message, extra={"fields": fields})
+
+
+def _attach_db_events(engine):
+    from flask import g, has_request_context
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_LATENCY.observe(elapsed)
+        if has_request_context():
+            g.db_queries = g.get("db_queries", 0) + 1
+            g.db_seconds = g.get("db_seconds", 0.0) + elapsed
+
+
+def init_app(app, engine):
+    """Per-request latency, DB query counts and a request log for ``app``."""
+    from flask import g, request
+
+    log = get_logger("http")
+    _attach_db_events(engine)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        start = g.get("request_start")
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # The URL rule keeps label cardinality bounded (/media/<rendition>/... not every file)
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(elapsed)
+        DB_QUERIES.labels(route).observe(g.db_queries)
+        elapsed_ms = elapsed * 1000
+        if LOG_REQUESTS or elapsed_ms >= SLOW_REQUEST_MS:
+            log_event(log, logging.INFO if elapsed_ms < SLOW_REQUEST_MS else logging.WARNING, "request",
+                      method=request.method, route=route, path=request.path, status=response.status_code,
+                      duration_ms=round(elapsed_ms, 2), db_queries=g.db_queries,
+                      db_ms=round(g.db_seconds * 1000, 2))
+        return response
+
+
+def metrics_response():
+    # (body, content type) in the Prometheus text format
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
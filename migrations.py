@@ -0,0 +1,298 @@
+import logging
+import warnings
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from geomatch import geocode
+from image_derivatives import source_digest
+from instrumentation import get_logger, log_event
+from nutrition import parse_amount
+
+# Applied versions are recorded here; each migration runs exactly once per database
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _meta,
+    Column("version", String(100), primary_key=True),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Arbitrary key for pg_advisory_lock so only one worker migrates at a time
+MIGRATION_LOCK_KEY = 420101
+
+log = get_logger("migrations")
+
+
+def _has_column(conn, table, column):
+    return column in {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+def _add_column(conn, table, column, ddl):
+    if not _has_column(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _create_index(conn, db, table, name):
+    # Indexes are declared on the models (so fresh databases get them from
+    # create_all); existing databases get them here
+    for index in db.metadata.tables[table].indexes:
+        if index.name == name:
+            with warnings.catch_warnings():
+                # checkfirst reflects the table's indexes, and says so for each expression index it skips
+                warnings.filterwarnings("ignore", "Skipped unsupported reflection of expression-based index")
+                index.create(conn, checkfirst=True)
+            return
+    raise LookupError(f"Index {name} is not declared on {table}")
+
+
+def _backfill(conn, table, source_to_target, chunk_size=1000):
+    # Parse "266 kcal"-style strings into the numeric columns, in chunks
+    sources = list(source_to_target)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text(f"SELECT id, {', '.join(sources)} FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit"),
+            {"last_id": last_id, "limit": chunk_size},
+        ).fetchall()
+        if not rows:
+            break
+        params = []
+        for row in rows:
+            values = {"id": row[0]}
+            for i, source in enumerate(sources):
+                values[source_to_target[source]] = parse_amount(row[i + 1])
+            params.append(values)
+        assignments = ", ".join(f"{target} = :{target}" for target in source_to_target.values())
+        conn.execute(text(f"UPDATE {table} SET {assignments} WHERE id = :id"), params)
+        last_id = rows[-1][0]
+
+
+def m001_initial_schema(conn, db):
+    # Creates whatever tables are missing; on a fresh database that is everything
+    db.metadata.create_all(conn)
+
+
+def m002_lookup_indexes(conn, db):
+    _create_index(conn, db, "donations", "ix_donations_contact_name_id")
+    _create_index(conn, db, "surplus_request", "ix_surplus_request_user_id")
+    _create_index(conn, db, "requested_items", "ix_requested_items_date")
+    _create_index(conn, db, "emergency_donations", "ix_emergency_donations_available_from")
+    _create_index(conn, db, "biofertilizer_listings", "ix_biofertilizer_listings_timestamp_id")
+    _create_index(conn, db, "biofertilizer_listings", "ix_biofertilizer_listings_pickup_date")
+    # ix_biofertilizer_listings_material_type_pickup_date was created here; 012 replaces it
+    _create_index(conn, db, "ngo_requirements", "ix_ngo_requirements_timestamp_id")
+    _create_index(conn, db, "ngo_requirements", "ix_ngo_requirements_pickup_date")
+    # users.email is already covered by the index behind its UNIQUE constraint
+
+
+def m003_donation_user_fk(conn, db):
+    _add_column(conn, "donations", "user_id", "INTEGER REFERENCES users (id)")
+    _create_index(conn, db, "donations", "ix_donations_user_id")
+    # Link existing donations to their user where the contact name is unambiguous
+    conn.execute(text(
+        "UPDATE donations SET user_id = (SELECT MIN(users.id) FROM users WHERE users.name = donations.contact_name) "
+        "WHERE user_id IS NULL AND (SELECT COUNT(*) FROM users WHERE users.name = donations.contact_name) = 1"
+    ))
+
+
+def m004_numeric_amounts(conn, db):
+    for column in ("quantity_value", "calories_kcal", "protein_g", "carbs_g", "fats_g"):
+        _add_column(conn, "donations", column, "FLOAT")
+    _add_column(conn, "emergency_donations", "quantity_value", "FLOAT")
+    _backfill(conn, "donations", {
+        "quantity": "quantity_value",
+        "calories": "calories_kcal",
+        "protein": "protein_g",
+        "carbs": "carbs_g",
+        "fats": "fats_g",
+    })
+    _backfill(conn, "emergency_donations", {"quantity": "quantity_value"})
+
+
+def m005_coordinates(conn, db):
+    tables = {
+        "donations": "location",
+        "emergency_donations": "location",
+        "food_aid_requests": "location",
+        "biofertilizer_listings": "pickup_location",
+        "ngo_requirements": "pickup_location",
+    }
+    for table, location_column in tables.items():
+        _add_column(conn, table, "latitude", "FLOAT")
+        _add_column(conn, table, "longitude", "FLOAT")
+        # Geocode existing rows against the gazetteer, in chunks
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                text(f"SELECT id, {location_column} FROM {table} WHERE id > :last_id ORDER BY id LIMIT 1000"),
+                {"last_id": last_id},
+            ).fetchall()
+            if not rows:
+                break
+            params = []
+            for row_id, location in rows:
+                point = geocode(location)
+                if point:
+                    params.append({"id": row_id, "latitude": point[0], "longitude": point[1]})
+            if params:
+                conn.execute(text(f"UPDATE {table} SET latitude = :latitude, longitude = :longitude WHERE id = :id"),
+                             params)
+            last_id = rows[-1][0]
+
+
+def m006_assignments(conn, db):
+    db.metadata.tables["assignments"].create(conn, checkfirst=True)
+
+
+def m007_change_events(conn, db):
+    db.metadata.tables["change_events"].create(conn, checkfirst=True)
+
+
+def m008_sessions(conn, db):
+    db.metadata.tables["sessions"].create(conn, checkfirst=True)
+
+
+def m009_analytics(conn, db):
+    _add_column(conn, "donations", "created_at", "TIMESTAMP")
+    db.metadata.tables["analytics_rollups"].create(conn, checkfirst=True)
+    db.metadata.tables["analytics_state"].create(conn, checkfirst=True)
+
+
+def m010_search(conn, db):
+    db.metadata.tables["search_documents"].create(conn, checkfirst=True)
+    db.metadata.tables["search_state"].create(conn, checkfirst=True)
+    if conn.dialect.name == "postgresql":
+        # Not in the model since SQLite has no tsvector type; search.py fills it in
+        conn.execute(text("ALTER TABLE search_documents ADD COLUMN IF NOT EXISTS document tsvector"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_search_documents_document "
+                          "ON search_documents USING GIN (document)"))
+        # Fuzzy matching on titles needs pg_trgm, which some managed databases do not allow
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except Exception:
+            log_event(log, logging.WARNING, "pg_trgm is not available; search will not fall back to fuzzy matching")
+        else:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_search_documents_title_trgm "
+                              "ON search_documents USING GIN (title gin_trgm_ops)"))
+    elif conn.dialect.name == "sqlite":
+        # Same text as search_documents.body, under the same rowid as search_documents.id
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts "
+                          "USING fts5(body, tokenize='porter unicode61')"))
+
+
+def m011_prediction_job_backoff(conn, db):
+    _add_column(conn, "prediction_jobs", "not_before", "TIMESTAMP")
+
+
+def m012_lower_material_type_index(conn, db):
+    # The material filter compares lower(material_type), which a plain index on the column cannot serve
+    conn.execute(text("DROP INDEX IF EXISTS ix_biofertilizer_listings_material_type_pickup_date"))
+    # IF NOT EXISTS rather than checkfirst: reflection does not see expression indexes
+    for index in db.metadata.tables["biofertilizer_listings"].indexes:
+        if index.name == "ix_biofertilizer_listings_lower_material_type_pickup_date":
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def m013_split_assignments(conn, db):
+    # Supplies may now be split over several demands, so the unique constraint
+    # moves from the supply to the (supply, demand) pair
+    constraints = {c["name"] for c in inspect(conn).get_unique_constraints("assignments")}
+    if "uq_assignments_supply" not in constraints:
+        return  # Created by m001 with the new index already
+    if conn.dialect.name == "sqlite":
+        # SQLite cannot drop a constraint, so the rows are copied into a new table
+        table = db.metadata.tables["assignments"]
+        for index in table.indexes:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        conn.execute(text("ALTER TABLE assignments RENAME TO assignments_old"))
+        table.create(conn)
+        columns = ", ".join(column.name for column in table.columns)
+        conn.execute(text(f"INSERT INTO assignments ({columns}) SELECT {columns} FROM assignments_old"))
+        conn.execute(text("DROP TABLE assignments_old"))
+    else:
+        conn.execute(text("ALTER TABLE assignments DROP CONSTRAINT uq_assignments_supply"))
+        _create_index(conn, db, "assignments", "uq_assignments_supply_demand")
+
+
+def m014_donation_image_digest(conn, db):
+    # Digests for existing photos, so listing donations no longer hashes the originals
+    _add_column(conn, "donations", "image_digest", "VARCHAR(32)")
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, image_url FROM donations WHERE id > :last_id ORDER BY id LIMIT 1000"),
+            {"last_id": last_id},
+        ).fetchall()
+        if not rows:
+            break
+        params = [{"id": row[0], "digest": source_digest(row[1])} for row in rows]
+        params = [p for p in params if p["digest"] is not None]
+        if params:
+            conn.execute(text("UPDATE donations SET image_digest = :digest WHERE id = :id"), params)
+        last_id = rows[-1][0]
+
+
+def m015_prediction_job_top_k(conn, db):
+    _add_column(conn, "prediction_jobs", "top_k", "TEXT")
+    _add_column(conn, "prediction_jobs", "estimated_nutrients", "TEXT")
+
+
+MIGRATIONS = [
+    ("001_initial_schema", m001_initial_schema),
+    ("002_lookup_indexes", m002_lookup_indexes),
+    ("003_donation_user_fk", m003_donation_user_fk),
+    ("004_numeric_amounts", m004_numeric_amounts),
+    ("005_coordinates", m005_coordinates),
+    ("006_assignments", m006_assignments),
+    ("007_change_events", m007_change_events),
+    ("008_sessions", m008_sessions),
+    ("009_analytics", m009_analytics),
+    ("010_search", m010_search),
+    ("011_prediction_job_backoff", m011_prediction_job_backoff),
+    ("012_lower_material_type_index", m012_lower_material_type_index),
+    ("013_split_assignments", m013_split_assignments),
+    ("014_donation_image_digest", m014_donation_image_digest),
+    ("015_prediction_job_top_k", m015_prediction_job_top_k),
+]
+
+
+def _no_statement_timeout(conn):
+    # Backfills and the wait for another worker's migrations can outlast DB_STATEMENT_TIMEOUT_MS;
+    # SET LOCAL ends with the transaction, so pooled connections keep the timeout
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+
+
+def migrate(db):
+    """Apply pending migrations, each in its own transaction."""
+    engine = db.engine
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "postgresql":
+            # Workers booting together would otherwise race on the same DDL
+            _no_statement_timeout(lock_conn)
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            with engine.begin() as conn:
+                _meta.create_all(conn)
+                applied = {row[0] for row in conn.execute(schema_migrations.select())}
+            for version, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                with engine.begin() as conn:
+                    _no_statement_timeout(conn)
+                    migration(conn, db)
+                    conn.execute(schema_migrations.insert().values(version=version, applied_at=datetime.now()))
+                log_event(log, logging.INFO, "applied migration", version=version)
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                lock_conn.commit()
+
+
+if __name__ == "__main__":
+    from app import app, dp
+
+    with app.app_context():
+        migrate(dp)
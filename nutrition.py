@@ -0,0 +1,44 @@
+import csv
+import os
+import re
+
+_NUMBER = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+
+
+def parse_amount(value):
+    # "266 kcal" -> 266.0, "19.4 g" -> 19.4, "5 kg" -> 5.0; None when there is no number
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER.search(str(value))
+    if not match:
+        return None
+    return float(match.group().replace(",", "."))
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+NUTRIENTS_PATH = os.path.join(BASE_DIR, "food-101", "meta", "nutrients.csv")
+
+# (display name, column in nutrients.csv, unit), in table column order
+NUTRIENT_FIELDS = [
+    ("Calories", "calories_kcal", "kcal"),
+    ("Protein", "protein_g", "g"),
+    ("Carbs", "carbs_g", "g"),
+    ("Fats", "fats_g", "g"),
+]
+
+
+def load_nutrient_table(classes, path=NUTRIENTS_PATH):
+    # One row of numeric values per class id, in the order of classes.txt
+    with open(path, "r", newline="") as f:
+        rows = {row["class"]: row for row in csv.DictReader(f)}
+    missing = [name for name in classes if name not in rows]
+    if missing:
+        raise ValueError(f"{path} has no nutrients for: {', '.join(missing)}")
+    return [[float(rows[name][column]) for _, column, _ in NUTRIENT_FIELDS] for name in classes]
+
+
+def format_nutrients(values):
+    # [266.0, 11.0, 33.0, 10.0] -> {"Calories": "266 kcal", "Protein": "11 g", ...}
+    return {name: f"{round(value, 1):g} {unit}" for (name, _, unit), value in zip(NUTRIENT_FIELDS, values)}
@@ -0,0 +1,131 @@
+import base64
+import json
+import os
+from datetime import date, datetime
+
+from flask import jsonify, request
+from sqlalchemy import and_, func, or_
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 200))
+
+
+class PaginationError(ValueError):
+    """Raised for malformed cursor, limit or filter parameters."""
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, (date, datetime)) else v for v in values]
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise PaginationError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise PaginationError("Invalid cursor")
+    return [_parse_value(column, value) for column, value in zip(columns, values)]
+
+
+def _parse_value(column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is date:
+            return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise PaginationError(f"Invalid value for {column.key}")
+    return value
+
+
+def _after(columns, values):
+    # (c1, c2, ...) > (v1, v2, ...) spelled out so it works on every backend
+    clauses = []
+    for i, column in enumerate(columns):
+        equal_prefix = [columns[j] == values[j] for j in range(i)]
+        clauses.append(and_(*equal_prefix, column > values[i]))
+    return or_(*clauses)
+
+
+def page_size(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise PaginationError("limit must be an integer")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def apply_filters(query, filters, args):
+    """Push query-string filters into SQL.
+
+    ``filters`` maps a query parameter to ``(column, op)`` where op is one of
+    ``eq`` (equality; case-insensitive on text, as ``lower(column) = ...`` so
+    an index on ``lower(column)`` serves it), ``contains`` (case-insensitive
+    substring), ``gte`` or ``lte`` (dates as YYYY-MM-DD).
+    """
+    for param, (column, op) in filters.items():
+        value = args.get(param)
+        if not value:
+            continue
+        if op == "eq":
+            python_type = column.type.python_type
+            if python_type is str:
+                query = query.filter(func.lower(column) == value.lower())
+            else:
+                try:
+                    query = query.filter(column == python_type(value))
+                except ValueError:
+                    raise PaginationError(f"{param} must be a {python_type.__name__}")
+        elif op == "contains":
+            query = query.filter(column.ilike(f"%{_escape_like(value)}%", escape="\\"))
+        elif op in ("gte", "lte"):
+            try:
+                bound = date.fromisoformat(value)
+            except ValueError:
+                raise PaginationError(f"{param} must be a date in YYYY-MM-DD format")
+            if column.type.python_type is datetime:
+                bound = datetime.combine(bound, datetime.max.time() if op == "lte" else datetime.min.time())
+            query = query.filter(column >= bound if op == "gte" else column <= bound)
+        else:
+            raise ValueError(f"Unknown filter operator {op!r}")
+    return query
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", r"\%").replace("_", r"\_")
+
+
+def page_query(query, order_columns, filters=None, args=None):
+    # The query paginate() runs for one page (one extra row tells whether there is a next page)
+    args = request.args if args is None else args
+    query = apply_filters(query, filters or {}, args)
+    limit = page_size(args)
+    cursor = args.get("cursor")
+    if cursor:
+        query = query.filter(_after(order_columns, decode_cursor(cursor, order_columns)))
+    return query.order_by(*order_columns).limit(limit + 1)
+
+
+def paginate(query, order_columns, filters=None, args=None):
+    """Return one page of ``query`` ordered by ``order_columns`` plus the cursor for the next page.
+
+    The cursor holds the sort key of the last row, so each page is an indexed
+    range scan no matter how deep the client pages.
+    """
+    args = request.args if args is None else args
+    limit = page_size(args)
+    rows = page_query(query, order_columns, filters, args).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in order_columns])
+    return rows, next_cursor
+
+
+def page_response(items, next_cursor):
+    return jsonify({"items": items, "next_cursor": next_cursor})
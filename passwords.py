@@ -0,0 +1,189 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from instrumentation import PASSWORD_HASH_QUEUE, PASSWORD_HASH_SECONDS, get_logger
+
+log = get_logger("passwords")
+
+
+class PasswordBusyError(Exception):
+    """Raised when too many hashes are already waiting and the caller should back off."""
+
+
+class PasswordService:
+    """Password hashing and verification on a small dedicated thread pool.
+
+    A slow KDF (scrypt by default) is what makes stolen hashes expensive to
+    crack, but in a request thread every login holds that thread for the
+    whole hash. Here at most ``workers`` hashes run at once per process and
+    at most ``max_pending`` more may wait; past that, callers get
+    ``PasswordBusyError`` straight away instead of queueing, so a burst of
+    logins is turned away with a 503 while the other routes keep their
+    threads. Keep ``workers + max_pending`` well below the request threads
+    per process: every waiting hash holds one. hashlib releases the GIL
+    while it hashes, so the pool runs on separate cores.
+    """
+
+    def __init__(self, method="scrypt", workers=2, max_pending=4, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._after_fork()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Threads do not survive fork(); each worker process starts its own pool
+        self._executor = None
+        self._dummy = None  # Future of a hash with the current parameters, the pool's first task
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    executor = ThreadPoolExecutor(self.workers, thread_name_prefix="password-hash")
+                    self._dummy = executor.submit(generate_password_hash, "not a password", self.method)
+                    self._executor = executor
+        return self._executor
+
+    def _submit(self, op, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordBusyError("Too many password hashes in progress")
+        PASSWORD_HASH_QUEUE.inc()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                PASSWORD_HASH_SECONDS.labels(op).observe(time.perf_counter() - start)
+
+        def done(future):
+            # The slot is held until the hash finishes, even if the caller gave up waiting
+            self._slots.release()
+            PASSWORD_HASH_QUEUE.dec()
+
+        future = self._pool().submit(run)
+        future.add_done_callback(done)
+        return future
+
+    def _wait(self, future):
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            raise PasswordBusyError("Timed out waiting for a password hash")
+
+    def _dummy_hash(self):
+        # Waits for the pool's first task rather than hashing in the calling thread
+        self._pool()
+        return self._wait(self._dummy)
+
+    def _check_dummy(self, password):
+        # On the pool, where the dummy hash was queued ahead of this task
+        return check_password_hash(self._dummy.result(), password)
+
+    def hash(self, password):
+        return self._wait(self._submit("hash", generate_password_hash, password, self.method))
+
+    def verify(self, stored, password):
+        # Unknown users are checked against a dummy hash, so the response time
+        # does not reveal which emails are registered
+        if stored is None:
+            self._wait(self._submit("verify", self._check_dummy, password))
+            return False
+        return self._wait(self._submit("verify", check_password_hash, stored, password))
+
+    def needs_rehash(self, stored):
+        # Hashes look like "scrypt:32768:8:1$salt$hash"; compare the parameters before the first "$"
+        return stored.split("$", 1)[0] != self._dummy_hash().split("$", 1)[0]
+
+    def rehash_later(self, password, save):
+        # Compute a hash with the current parameters in the background and pass it to `save`.
+        # Skipped when the pool is busy; the next login tries again.
+        try:
+            future = self._submit("hash", generate_password_hash, password, self.method)
+        except PasswordBusyError:
+            return
+
+        def saved(future):
+            try:
+                save(future.result())
+            except Exception:
+                log.exception("Error saving rehashed password")
+
+        future.add_done_callback(saved)
+
+
+class RateLimiter:
+    """At most ``limit`` hits per ``window`` seconds for each key, in this process.
+
+    Keeps the hit times of the ``max_keys`` most recently seen keys. Each
+    worker counts on its own, so the effective limit is ``limit`` times the
+    number of workers the requests spread over.
+    """
+
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._hits = OrderedDict()  # key -> deque of monotonic times
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        return hits
+
+    def retry_after(self, key):
+        # Seconds until `key` may be hit again; 0 if it may be hit now
+        now = time.monotonic()
+        with self._lock:
+            hits = self._recent(key, now)
+            if not hits or len(hits) < self.limit:
+                return 0
+            return max(1, math.ceil(hits[0] + self.window - now))
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._recent(key, now)
+            if hits is None:
+                hits = self._hits[key] = deque()
+            hits.append(now)
+            self._hits.move_to_end(key)
+            while len(self._hits) > self.max_keys:
+                self._hits.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+def service_from_env():
+    return PasswordService(
+        method=os.environ.get("PASSWORD_HASH_METHOD", "scrypt"),
+        workers=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+        max_pending=int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 4)),
+        timeout=float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10)),
+    )
+
+
+def limiters_from_env():
+    # (per-IP login attempts, failed logins per email, per-IP signups)
+    return (
+        RateLimiter(int(os.environ.get("LOGIN_RATE_PER_IP", 20)), 60),
+        RateLimiter(int(os.environ.get("LOGIN_FAILURES_PER_EMAIL", 5)), 900),
+        RateLimiter(int(os.environ.get("SIGNUP_RATE_PER_IP", 5)), 3600),
+    )
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import get_logger, log_event
+
+log = get_logger("prediction_cache")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_fingerprint(path):
+    # Size + mtime is enough to notice a replaced checkpoint without hashing 100 MB
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+class PredictionCache:
+    """Two-tier cache for predictions keyed by image content hash.
+
+    The first tier is an in-process LRU; the optional second tier stores one
+    small JSON file per entry under ``disk_dir`` so results survive restarts
+    and are shared by workers on the same machine. Entries expire after
+    ``ttl_seconds`` in both tiers.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=86400, disk_dir=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, value, now)
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._store(key, value, now)
+        self._disk_set(key, value, now)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _store(self, key, value, now):
+        self._entries[key] = (now + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires_at", 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry.get("value")
+
+    def _disk_set(self, key, value, now):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file first so concurrent readers never see half a file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"expires_at": now + self.ttl_seconds, "value": value}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log_event(log, logging.ERROR, "prediction cache write failed", path=path, error=str(e))
+            return
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._prune_disk(now)
+
+    def _prune_disk(self, now):
+        # Drop expired files, then the oldest ones if the tier is over its bound
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if mtime + self.ttl_seconds <= now:
+                    _silent_remove(path)
+                else:
+                    files.append((mtime, path))
+        if len(files) > self.max_disk_entries:
+            files.sort()
+            for _, path in files[:len(files) - self.max_disk_entries]:
+                _silent_remove(path)
+
+
+def _silent_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def cache_from_env():
+    return PredictionCache(
+        max_entries=int(os.environ.get("FOOD_CACHE_SIZE", 1024)),
+        ttl_seconds=float(os.environ.get("FOOD_CACHE_TTL", 86400)),
+        disk_dir=os.environ.get("FOOD_CACHE_DIR") or None,
+        max_disk_entries=int(os.environ.get("FOOD_CACHE_DISK_SIZE", 10000)),
+    )
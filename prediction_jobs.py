@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select, update
+
+from batch_inference import QueueFullError
+from instrumentation import get_logger, log_event
+from nutrition import parse_amount
+
+log = get_logger("prediction_jobs")
+
+
+class PredictionJobQueue:
+    """Database-backed queue of nutrient predictions for new donations.
+
+    Jobs live in the ``prediction_jobs`` table, so they survive restarts and
+    can be picked up by any worker process (or by a standalone
+    ``python prediction_jobs.py`` process). Claiming uses a conditional
+    UPDATE, which works the same on Postgres and SQLite. A job is not
+    claimed before its ``not_before`` time: new jobs wait for their image to
+    reach disk, and failed attempts back off exponentially from
+    ``retry_backoff`` seconds.
+    """
+
+    def __init__(self, app, db, job_model, donation_model, predict_fn, workers=2, poll_interval=2.0,
+                 max_attempts=3, stale_after=300, retry_backoff=30):
+        self.app = app
+        self.db = db
+        self.job_model = job_model
+        self.donation_model = donation_model
+        self.predict_fn = predict_fn
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.stale_after = timedelta(seconds=stale_after)
+        self.retry_backoff = retry_backoff
+        self._pending_data = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def enqueue(self, donation_id, image_path):
+        # Adds the job to the current session; the caller commits it together with the donation.
+        # No worker claims it until notify() reports the image saved, or stale_after has passed
+        # (the process saving it died).
+        now = datetime.now()
+        job = self.job_model(donation_id=donation_id, image_path=image_path, status="pending",
+                             attempts=0, updated_at=now, not_before=now + self.stale_after)
+        self.db.session.add(job)
+        return job
+
+    def notify(self, job_id, data=None, saved=None):
+        # Call after committing the job. `saved` is the Future of the image write; the job becomes
+        # claimable once it is done. `data`, the upload bytes, spares this process's worker the read.
+        if data is not None:
+            self._pending_data[job_id] = data
+        if saved is None:
+            self._release(job_id)
+        else:
+            saved.add_done_callback(lambda future: self._release(job_id))
+
+    def _release(self, job_id):
+        Job = self.job_model
+        try:
+            with self.app.app_context():
+                session = self.db.session
+                session.execute(update(Job).where(Job.id == job_id, Job.status == "pending").values(not_before=None))
+                session.commit()
+        except Exception as e:
+            # The job is claimed after stale_after instead
+            log_event(log, logging.ERROR, "releasing prediction job failed", job_id=job_id, error=str(e))
+            return
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        if self._threads and all(t.is_alive() for t in self._threads):
+            return
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="prediction-jobs", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def run_forever(self):
+        # Standalone worker process
+        self._work()
+
+    def _after_fork(self):
+        self._pending_data = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            try:
+                job_id = self._claim_next()
+            except Exception as e:
+                log_event(log, logging.ERROR, "claiming prediction job failed", error=str(e))
+                job_id = None
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job_id)
+
+    def _claim_next(self):
+        Job = self.job_model
+        with self.app.app_context():
+            session = self.db.session
+            now = datetime.now()
+            # Jobs left "running" by a crashed worker go back in the queue
+            session.execute(
+                update(Job)
+                .where(Job.status == "running", Job.updated_at < now - self.stale_after)
+                .values(status="pending", updated_at=now)
+            )
+            session.commit()
+            self._forget_claimed(session)
+
+            ready = or_(Job.not_before.is_(None), Job.not_before <= now)
+            candidates = (session.query(Job.id).filter(Job.status == "pending", ready)
+                          .order_by(Job.id).limit(self.workers * 2).all())
+            for (job_id,) in candidates:
+                claimed = session.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status == "pending", ready)
+                    .values(status="running", attempts=Job.attempts + 1, updated_at=now)
+                )
+                session.commit()
+                if claimed.rowcount == 1:
+                    return job_id
+        return None
+
+    def _forget_claimed(self, session):
+        # Drop upload bytes held for jobs another process has claimed (or that were deleted)
+        held = list(self._pending_data)
+        if not held:
+            return
+        Job = self.job_model
+        pending = set(session.scalars(select(Job.id).where(Job.id.in_(held), Job.status == "pending")))
+        for job_id in held:
+            if job_id not in pending:
+                self._pending_data.pop(job_id, None)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            session = self.db.session
+            job = session.get(self.job_model, job_id)
+            data = self._pending_data.pop(job_id, None)
+            try:
+                if data is None:
+                    with open(job.image_path, "rb") as f:
+                        data = f.read()
+                prediction = self.predict_fn(data)
+            except QueueFullError:
+                # Inference is saturated; put the job back without counting the attempt
+                self._pending_data[job_id] = data
+                job.status = "pending"
+                job.attempts -= 1
+                job.updated_at = datetime.now()
+                session.commit()
+                self._wakeup.wait(0.5)
+                return
+            except Exception as e:
+                job.status = "failed" if job.attempts >= self.max_attempts else "pending"
+                job.error = str(e)
+                job.updated_at = datetime.now()
+                # 30 s, 60 s, 120 s, ... so a transient error does not use up every attempt at once
+                job.not_before = job.updated_at + timedelta(seconds=self.retry_backoff * 2 ** (job.attempts - 1))
+                session.commit()
+                log_event(log, logging.ERROR, "prediction job failed", job_id=job_id, attempts=job.attempts,
+                          status=job.status, error=str(e))
+                return
+
+            try:
+                donation = session.get(self.donation_model, job.donation_id)
+                if donation is not None:
+                    nutrients = prediction["nutrients"]
+                    donation.calories = nutrients.get("Calories")
+                    donation.protein = nutrients.get("Protein")
+                    donation.carbs = nutrients.get("Carbs")
+                    donation.fats = nutrients.get("Fats")
+                    donation.calories_kcal = parse_amount(donation.calories)
+                    donation.protein_g = parse_amount(donation.protein)
+                    donation.carbs_g = parse_amount(donation.carbs)
+                    donation.fats_g = parse_amount(donation.fats)
+                job.status = "done"
+                job.food_name = prediction["food"]
+                job.top_k = json.dumps(prediction["top_k"])
+                job.estimated_nutrients = json.dumps(prediction["estimated_nutrients"])
+                job.error = None
+                job.updated_at = datetime.now()
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                log_event(log, logging.ERROR, "saving prediction job failed", job_id=job_id, error=str(e))
+
+
+def queue_from_env(app, db, job_model, donation_model, predict_fn):
+    return PredictionJobQueue(
+        app, db, job_model, donation_model, predict_fn,
+        workers=int(os.environ.get("PREDICTION_JOB_WORKERS", 2)),
+        poll_interval=float(os.environ.get("PREDICTION_JOB_POLL_SECONDS", 2)),
+        max_attempts=int(os.environ.get("PREDICTION_JOB_MAX_ATTEMPTS", 3)),
+        retry_backoff=float(os.environ.get("PREDICTION_JOB_RETRY_SECONDS", 30)),
+    )
+
+
+if __name__ == "__main__":
+    from app import prediction_jobs
+
+    log_event(log, logging.INFO, "prediction job worker started")
+    prediction_jobs.run_forever()
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+
+import food_predictor
+from app import app, analytics, dp, search_index, Donation, PredictionJob
+from nutrition import NUTRIENT_FIELDS, format_nutrients
+
+DEFAULT_CHECKPOINT = os.path.join("model", "repredict_checkpoint.json")
+
+
+def load_checkpoint(path, version):
+    if not os.path.exists(path):
+        return {"model_version": version, "last_id": 0, "updated": 0, "failed": 0}
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("model_version") != version:
+        # A checkpoint from another model is meaningless for this run
+        print("Checkpoint belongs to a different model; starting over")
+        return {"model_version": version, "last_id": 0, "updated": 0, "failed": 0}
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _row_chunks(conn, after_id, chunk_size):
+    # Yields lists of (id, image_url) in id order
+    query = select(Donation.id, Donation.image_url).order_by(Donation.id)
+    if conn.dialect.name == "postgresql":
+        # Server-side cursor: rows arrive chunk by chunk over one query
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(
+            query.where(Donation.id > after_id))
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+        return
+    # SQLite and friends would hold a read lock for the whole scan and block
+    # the UPDATEs, so page through the primary key instead
+    while True:
+        chunk = conn.execute(query.where(Donation.id > after_id).limit(chunk_size)).fetchall()
+        conn.commit()
+        if not chunk:
+            return
+        yield chunk
+        after_id = chunk[-1][0]
+
+
+def _decode(row):
+    donation_id, image_url = row
+    try:
+        return donation_id, food_predictor.load_image(image_url)
+    except Exception as e:
+        print(f"Skipping donation {donation_id}: {e}")
+        return donation_id, None
+
+
+def _predict(decoded, image_urls, batch_size):
+    # Returns {"id": ..., "calories": ..., ...} rows ready for a bulk UPDATE, and
+    # a done prediction job per donation recording the new prediction
+    table = food_predictor.get_nutrient_table()
+    rows, jobs = [], []
+    now = datetime.now()
+    for start in range(0, len(decoded), batch_size):
+        chunk = decoded[start:start + batch_size]
+        results = food_predictor.predict_batch([image for _, image in chunk])
+        for (donation_id, _), result in zip(chunk, results):
+            values = table[result["class_id"]].tolist()
+            nutrients = format_nutrients(values)
+            row = {"id": donation_id}
+            for (name, column, _), value in zip(NUTRIENT_FIELDS, values):
+                row[name.lower()] = nutrients[name]  # calories, protein, carbs, fats
+                row[column] = value  # calories_kcal, protein_g, ...
+            rows.append(row)
+            jobs.append({
+                "donation_id": donation_id, "image_path": image_urls[donation_id], "status": "done", "attempts": 1,
+                "food_name": result["food"], "top_k": json.dumps(result["top_k"]),
+                "estimated_nutrients": json.dumps(result["estimated_nutrients"]), "created_at": now, "updated_at": now,
+            })
+    return rows, jobs
+
+
+def repredict(chunk_size, batch_size, prefetch_threads, checkpoint_path, restart=False):
+    version = food_predictor.model_version()
+    checkpoint = {"model_version": version, "last_id": 0, "updated": 0, "failed": 0}
+    if not restart:
+        checkpoint = load_checkpoint(checkpoint_path, version)
+    food_predictor.preload()
+
+    total = dp.session.query(Donation).filter(Donation.id > checkpoint["last_id"]).count()
+    print(f"{total} donations to re-predict (resuming after id {checkpoint['last_id']})")
+
+    started = time.perf_counter()
+    done = 0
+    with dp.engine.connect() as read_conn, ThreadPoolExecutor(max_workers=prefetch_threads) as pool:
+        chunks = _row_chunks(read_conn, checkpoint["last_id"], chunk_size)
+        next_chunk = next(chunks, None)
+        pending = pool.map(_decode, next_chunk) if next_chunk else None
+        while next_chunk:
+            current, decoded = next_chunk, list(pending)
+            # Start decoding the following chunk while this one runs through the model
+            next_chunk = next(chunks, None)
+            pending = pool.map(_decode, next_chunk) if next_chunk else None
+
+            ok = [(donation_id, image) for donation_id, image in decoded if image is not None]
+            rows, jobs = _predict(ok, dict(current), batch_size) if ok else ([], [])
+            if rows:
+                dp.session.execute(update(Donation), rows)
+                # Analytics and search pick up donations through their done jobs, as for new donations
+                dp.session.execute(insert(PredictionJob), jobs)
+            dp.session.commit()
+
+            done += len(current)
+            checkpoint["last_id"] = current[-1][0]
+            checkpoint["updated"] += len(rows)
+            checkpoint["failed"] += len(decoded) - len(ok)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.perf_counter() - started
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            print(f"{done}/{total} donations ({rate:.1f}/s, ETA {eta:.0f}s), "
+                  f"{checkpoint['updated']} updated, {checkpoint['failed']} failed")
+
+    # Bring the donation rollups and the search index up to date now rather than on their next refresh
+    analytics.refresh(["donations"])
+    search_index.sync()
+    return checkpoint
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run the food model over stored donations")
+    parser.add_argument("--chunk-size", type=int, default=500, help="rows fetched and committed together")
+    parser.add_argument("--batch-size", type=int, default=32, help="images per forward pass")
+    parser.add_argument("--prefetch-threads", type=int, default=4, help="threads reading and decoding images")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="ignore any existing checkpoint")
+    args = parser.parse_args()
+
+    with app.app_context():
+        summary = repredict(args.chunk_size, args.batch_size, args.prefetch_threads, args.checkpoint, args.restart)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,140 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, make_response, request
+
+from instrumentation import get_logger, log_event
+
+log = get_logger("response_cache")
+
+
+class ResponseCache:
+    """Read-through cache for serialized JSON responses.
+
+    Entries are grouped in namespaces (one per table). A write bumps the
+    namespace's generation number, which changes every key in it, so stale
+    entries are never served and simply age out. With ``redis_url`` the
+    generations and entries live in Redis and are shared by all workers;
+    otherwise they are per process and other workers may serve data up to
+    ``ttl_seconds`` old.
+    """
+
+    def __init__(self, max_entries=512, ttl_seconds=300, redis_url=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            try:
+                import redis
+            except ImportError:
+                log_event(log, logging.WARNING, "redis package not installed; using the in-process cache only")
+            else:
+                self._redis = redis.Redis.from_url(redis_url)
+
+    def generation(self, namespace):
+        if self._redis is not None:
+            try:
+                return int(self._redis.get(f"frn:gen:{namespace}") or 0)
+            except Exception as e:
+                log_event(log, logging.ERROR, "cache generation read failed", error=str(e))
+        return self._generations.get(namespace, 0)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+        if self._redis is not None:
+            try:
+                self._redis.incr(f"frn:gen:{namespace}")
+            except Exception as e:
+                log_event(log, logging.ERROR, "cache invalidation failed", namespace=namespace, error=str(e))
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+        if self._redis is not None:
+            try:
+                raw = self._redis.get(f"frn:resp:{key}")
+            except Exception as e:
+                log_event(log, logging.ERROR, "cache read failed", error=str(e))
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self._store(key, value, now)
+                return value
+        return None
+
+    def set(self, key, value):
+        self._store(key, value, time.time())
+        if self._redis is not None:
+            try:
+                self._redis.setex(f"frn:resp:{key}", int(self.ttl_seconds), json.dumps(value))
+            except Exception as e:
+                log_event(log, logging.ERROR, "cache write failed", error=str(e))
+
+    def _store(self, key, value, now):
+        with self._lock:
+            self._entries[key] = (now + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def cached(self, namespace):
+        # Decorator for GET views whose JSON only changes when `namespace` is invalidated
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                key = f"{namespace}:{self.generation(namespace)}:{request.full_path}"
+                entry = self.get(key)
+                status = "HIT"
+                if entry is None:
+                    status = "MISS"
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data(as_text=True)
+                    entry = {
+                        "body": body,
+                        "etag": hashlib.sha1(body.encode()).hexdigest(),
+                        "mimetype": response.mimetype,
+                    }
+                    self.set(key, entry)
+
+                if entry["etag"] in request.if_none_match:
+                    response = Response(status=304)
+                else:
+                    response = Response(entry["body"], mimetype=entry["mimetype"])
+                response.set_etag(entry["etag"])
+                # Browsers may keep the body but must revalidate; a 304 costs no query
+                response.cache_control.no_cache = True
+                response.headers["X-Cache"] = status
+                return response
+            return wrapper
+        return decorator
+
+
+def cache_from_env():
+    redis_url = os.environ.get("REDIS_URL") or None
+    # Without Redis, writes are only seen by the worker that made them, so
+    # keep entries short-lived by default
+    default_ttl = 300 if redis_url else 30
+    return ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", 512)),
+        ttl_seconds=float(os.environ.get("RESPONSE_CACHE_TTL", default_ttl)),
+        redis_url=redis_url,
+    )
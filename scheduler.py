@@ -0,0 +1,329 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, text
+from sqlalchemy.exc import IntegrityError
+
+from geomatch import GridIndex
+from instrumentation import get_logger, log_event
+
+# Arbitrary key for pg_advisory_lock so only one scheduler assigns at a time
+SCHEDULER_LOCK_KEY = 420102
+
+log = get_logger("scheduler")
+
+
+class IndexedHeap:
+    """Min-heap of keys by priority, with update and removal by key.
+
+    Replaced or removed entries are only marked dead and skipped when they
+    reach the top, so every operation stays O(log n).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def push(self, key, priority, item=None):
+        self.remove(key)
+        entry = [priority, next(self._counter), key, item, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[4] = False
+
+    def pop(self):
+        # (key, priority, item) with the smallest priority
+        while self._heap:
+            priority, _, key, item, alive = heapq.heappop(self._heap)
+            if alive:
+                del self._entries[key]
+                return key, priority, item
+        raise IndexError("pop from an empty IndexedHeap")
+
+    def peek(self):
+        while self._heap and not self._heap[0][4]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            raise IndexError("peek at an empty IndexedHeap")
+        return self._heap[0][2], self._heap[0][0]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Pool:
+    """Supplies and demands that can be assigned to each other.
+
+    ``supplies`` and ``demands`` map a kind to a loader taking ``after_id``
+    and returning dicts for rows with a larger id. Supplies carry ``id``,
+    ``deadline``, ``latitude``, ``longitude`` and ``amount``; demands carry
+    ``id``, ``latitude``, ``longitude`` and ``capacity``. ``compatible``
+    decides whether a supply may go to a demand.
+    """
+
+    def __init__(self, name, supplies, demands, compatible):
+        self.name = name
+        self.supplies = supplies
+        self.demands = demands
+        self.compatible = compatible
+
+
+class ExpiryScheduler:
+    """Assigns the supplies closest to expiry first, each to the nearest
+    compatible demand with capacity left (greedy, batch by batch).
+
+    State is kept between runs: each run only loads rows added since the
+    previous one, so a run costs O(new rows + assignments * log n) rather
+    than a full recomputation. A supply larger than its demand's remaining
+    capacity has the rest queued again for the next nearest demand. Supplies
+    with no compatible demand are parked until a demand arrives in their pool.
+    """
+
+    def __init__(self, app, db, assignment_model, pools, batch_size=500, radius_km=25, cell_km=10):
+        self.app = app
+        self.db = db
+        self.assignment_model = assignment_model
+        self.pools = pools
+        self.batch_size = batch_size
+        self.radius_km = radius_km
+        self.cell_km = cell_km
+        self.reset()
+
+    def reset(self):
+        self.queue = IndexedHeap()
+        self.grids = {pool.name: GridIndex(self.cell_km) for pool in self.pools}
+        self.parked = {pool.name: {} for pool in self.pools}
+        self.remaining = {}  # (demand kind, id) -> capacity left
+        self.high_water = {}  # kind -> largest id loaded
+        self.loaded = False
+
+    def _assigned_state(self):
+        Assignment = self.assignment_model
+        session = self.db.session
+        assigned = {(kind, supply_id): total for kind, supply_id, total in
+                    session.query(Assignment.supply_kind, Assignment.supply_id, func.sum(Assignment.amount))
+                    .group_by(Assignment.supply_kind, Assignment.supply_id)}
+        used = {(kind, demand_id): total for kind, demand_id, total in
+                session.query(Assignment.demand_kind, Assignment.demand_id, func.sum(Assignment.amount))
+                .group_by(Assignment.demand_kind, Assignment.demand_id)}
+        return assigned, used
+
+    def refresh(self, now):
+        # Loads rows added since the last refresh; the first one also reads existing assignments
+        assigned, used = self._assigned_state() if not self.loaded else ({}, {})
+        stats = {"new_supplies": 0, "new_demands": 0}
+        for pool in self.pools:
+            parked = self.parked[pool.name]
+            for key in [key for key, (_, supply) in parked.items() if supply["deadline"] < now]:
+                del parked[key]
+            new_demand = False
+            for kind, loader in pool.demands.items():
+                for demand in loader(self.high_water.get(kind, 0)):
+                    self.high_water[kind] = max(self.high_water.get(kind, 0), demand["id"])
+                    key = (kind, demand["id"])
+                    self.remaining[key] = demand["capacity"] - used.get(key, 0)
+                    if demand["latitude"] is None or self.remaining[key] <= 0:
+                        continue
+                    self.grids[pool.name].insert(demand["latitude"], demand["longitude"], dict(demand, kind=kind))
+                    stats["new_demands"] += 1
+                    new_demand = True
+            for kind, loader in pool.supplies.items():
+                for supply in loader(self.high_water.get(kind, 0)):
+                    self.high_water[kind] = max(self.high_water.get(kind, 0), supply["id"])
+                    key = (kind, supply["id"])
+                    left = supply["amount"] - assigned.get(key, 0)
+                    if left <= 0 or supply["latitude"] is None or supply["deadline"] < now:
+                        continue
+                    self.queue.push(key, supply["deadline"], (pool, dict(supply, kind=kind, amount=left)))
+                    stats["new_supplies"] += 1
+            if new_demand:
+                # Parked supplies get another chance now that there is somewhere new to send them
+                for key, (supply_pool, supply) in self.parked[pool.name].items():
+                    self.queue.push(key, supply["deadline"], (supply_pool, supply))
+                self.parked[pool.name] = {}
+        self.loaded = True
+        return stats
+
+    def _best_demand(self, pool, supply):
+        def available(demand):
+            return (self.remaining[(demand["kind"], demand["id"])] > 0
+                    and pool.compatible(supply, demand))
+
+        found = self.grids[pool.name].query(supply["latitude"], supply["longitude"], self.radius_km, available)
+        return found[0] if found else (None, None)
+
+    def assign_batch(self, now):
+        # Up to batch_size assignment rows, most urgent supplies first
+        rows, expired = [], 0
+        while self.queue and len(rows) < self.batch_size:
+            key, deadline, (pool, supply) = self.queue.pop()
+            if deadline < now:
+                expired += 1
+                continue
+            distance, demand = self._best_demand(pool, supply)
+            if demand is None:
+                self.parked[pool.name][key] = (pool, supply)
+                continue
+            demand_key = (demand["kind"], demand["id"])
+            amount = min(supply["amount"], self.remaining[demand_key])
+            self.remaining[demand_key] -= amount
+            if supply["amount"] > amount:
+                # That demand is now full; the rest goes to the next nearest one
+                self.queue.push(key, deadline, (pool, dict(supply, amount=supply["amount"] - amount)))
+            rows.append({
+                "pool": pool.name,
+                "supply_kind": supply["kind"],
+                "supply_id": supply["id"],
+                "demand_kind": demand["kind"],
+                "demand_id": demand["id"],
+                "amount": amount,
+                "distance_km": round(distance, 2),
+                "deadline": deadline,
+                "status": "scheduled",
+                "created_at": now,
+            })
+        return rows, expired
+
+    def _assign_all(self, now, stats):
+        # Assigns until the queue is empty; False if a batch conflicted with assignments made elsewhere
+        while self.queue:
+            rows, expired = self.assign_batch(now)
+            stats["expired"] += expired
+            if not rows:
+                continue
+            try:
+                self.db.session.execute(insert(self.assignment_model), rows)
+                self.db.session.commit()
+            except IntegrityError:
+                self.db.session.rollback()
+                return False
+            stats["assigned"] += len(rows)
+        return True
+
+    def run_once(self):
+        started = time.perf_counter()
+        now = datetime.now()
+        stats = {"new_supplies": 0, "new_demands": 0, "assigned": 0, "expired": 0, "conflicts": 0}
+        with self.app.app_context():
+            while True:
+                for key, value in self.refresh(now).items():
+                    stats[key] += value
+                if self._assign_all(now, stats):
+                    break
+                # Someone else assigned some of these; start over from the database, keeping the
+                # batches already committed in this run's stats
+                stats["conflicts"] += 1
+                log_event(log, logging.WARNING, "assignment conflict; reloading scheduler state",
+                          assigned=stats["assigned"])
+                self.reset()
+        stats["queued"] = len(self.queue)
+        stats["parked"] = sum(len(parked) for parked in self.parked.values())
+        stats["seconds"] = round(time.perf_counter() - started, 3)
+        return stats
+
+    def run_forever(self, interval):
+        with self.app.app_context():
+            lock_conn = self.db.engine.connect()
+        if lock_conn.dialect.name == "postgresql":
+            # Standby schedulers wait here until the active one exits
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEDULER_LOCK_KEY})
+        while True:
+            try:
+                stats = self.run_once()
+                if stats["assigned"] or stats["expired"]:
+                    log_event(log, logging.INFO, "scheduler run", **stats)
+            except Exception as e:
+                self.db.session.rollback()
+                log_event(log, logging.ERROR, "scheduler run failed", error=str(e))
+            time.sleep(interval)
+
+
+def _end_of_day(day):
+    return datetime.combine(day, datetime.max.time())
+
+
+def build_pools():
+    from app import BiofertilizerListing, Donation, EmergencyDonation, FoodAidRequest, NGORequirement
+
+    shelf_life = timedelta(hours=float(os.environ.get("SCHEDULER_DEFAULT_SHELF_HOURS", 24)))
+    request_capacity = int(os.environ.get("SCHEDULER_REQUEST_CAPACITY", 3))
+
+    def donations(after_id):
+        query = Donation.query.filter(Donation.id > after_id).order_by(Donation.id)
+        for row in query.yield_per(1000):
+            yield {"id": row.id, "deadline": _end_of_day(row.expiry), "amount": 1,
+                   "latitude": row.latitude, "longitude": row.longitude}
+
+    def emergency_donations(after_id):
+        query = EmergencyDonation.query.filter(EmergencyDonation.id > after_id).order_by(EmergencyDonation.id)
+        for row in query.yield_per(1000):
+            # Without an expiry, assume it keeps for SCHEDULER_DEFAULT_SHELF_HOURS after it becomes available
+            deadline = row.expiry or row.available_from + shelf_life
+            yield {"id": row.id, "deadline": deadline, "amount": 1,
+                   "latitude": row.latitude, "longitude": row.longitude}
+
+    def food_aid_requests(after_id):
+        query = FoodAidRequest.query.filter(FoodAidRequest.id > after_id).order_by(FoodAidRequest.id)
+        for row in query.yield_per(1000):
+            # Requests have no quantity, so each one takes a fixed number of donations
+            yield {"id": row.id, "capacity": request_capacity,
+                   "latitude": row.latitude, "longitude": row.longitude}
+
+    def biofertilizers(after_id):
+        query = BiofertilizerListing.query.filter(BiofertilizerListing.id > after_id).order_by(BiofertilizerListing.id)
+        for row in query.yield_per(1000):
+            yield {"id": row.id, "deadline": _end_of_day(row.pickup_date), "amount": row.quantity,
+                   "material": row.material_type.strip().lower(), "pickup_date": row.pickup_date,
+                   "latitude": row.latitude, "longitude": row.longitude}
+
+    def ngo_requirements(after_id):
+        query = NGORequirement.query.filter(NGORequirement.id > after_id).order_by(NGORequirement.id)
+        for row in query.yield_per(1000):
+            yield {"id": row.id, "capacity": row.quantity, "material": row.material_type.strip().lower(),
+                   "needed_by": row.pickup_date, "latitude": row.latitude, "longitude": row.longitude}
+
+    return [
+        Pool("food", {"donation": donations, "emergency_donation": emergency_donations},
+             {"food_aid_request": food_aid_requests}, lambda supply, demand: True),
+        Pool("biofertilizer", {"biofertilizer": biofertilizers}, {"ngo_requirement": ngo_requirements},
+             lambda supply, demand: (supply["material"] == demand["material"]
+                                     and supply["pickup_date"] <= demand["needed_by"])),
+    ]
+
+
+def scheduler_from_env():
+    from app import app, dp, Assignment
+
+    return ExpiryScheduler(
+        app, dp, Assignment, build_pools(),
+        batch_size=int(os.environ.get("SCHEDULER_BATCH_SIZE", 500)),
+        radius_km=float(os.environ.get("SCHEDULER_RADIUS_KM", 25)),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assign perishable donations to requesters by time to expiry")
+    parser.add_argument("--once", action="store_true", help="run one pass and exit")
+    parser.add_argument("--interval", type=float, default=float(os.environ.get("SCHEDULER_INTERVAL_SECONDS", 30)))
+    args = parser.parse_args()
+
+    scheduler = scheduler_from_env()
+    if args.once:
+        print(json.dumps(scheduler.run_once(), indent=2))
+    else:
+        log_event(log, logging.INFO, "scheduler started", interval=args.interval)
+        scheduler.run_forever(args.interval)
@@ -0,0 +1,290 @@
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import (String, and_, bindparam, column, delete, func, insert, literal, literal_column, or_, select,
+                        table, text, update)
+
+from geomatch import KM_PER_DEGREE, haversine_km
+
+# Arbitrary key for pg_try_advisory_xact_lock so only one worker syncs the index at a time
+SEARCH_LOCK_KEY = 420104
+
+TEXT_CONFIG = "english"  # Postgres text search configuration; SQLite uses the porter tokenizer to match
+TRIGRAM_THRESHOLD = 0.3  # word_similarity needed for a fuzzy match
+SYNC_CHUNK = 1000
+# Ids below the high-water mark checked again for rows that were not committed yet when it was recorded
+RESCAN_IDS = 1000
+
+# FTS5 table on SQLite, holding the same body text as search_documents under the same rowid
+fts = table("search_fts", column("rowid"), column("body"))
+
+
+def terms(query):
+    # Lowercase words of a query; punctuation and search operators are dropped
+    return re.findall(r"[^\W_]+", query.lower())[:10]
+
+
+class Source:
+    """One table feeding the search index.
+
+    ``documents(conn, rows)`` turns a batch of model rows into dicts with
+    ``row_id``, ``title``, ``body``, ``location``, ``latitude`` and
+    ``longitude``. ``changed(since)`` returns a select of ids of existing
+    rows whose text changed after ``since``; new rows are found by id.
+    """
+
+    def __init__(self, kind, model, documents, changed=None):
+        self.kind = kind
+        self.model = model
+        self.documents = documents
+        self.changed = changed
+
+
+class SearchIndex:
+    """Ranked full-text search over several tables through one document table.
+
+    Postgres matches a ``tsvector`` column with a GIN index (and falls back
+    to trigram similarity on titles when pg_trgm is installed and nothing
+    matched); SQLite matches an FTS5 table. The index is synced
+    incrementally from each source's id high-water mark (plus a trailing
+    window of ids for rows that committed late), at most every
+    ``sync_seconds`` per process, or on the next search after a write in
+    this process calls ``invalidate``.
+    """
+
+    def __init__(self, app, db, document_model, state_model, sources, sync_seconds=5):
+        self.app = app
+        self.db = db
+        self.documents = document_model.__table__
+        self.state = state_model.__table__
+        self.sources = {source.kind: source for source in sources}
+        self.sync_seconds = sync_seconds
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._trigram = None
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def _write(self, conn, kind, documents):
+        # Replace the documents of these rows
+        Docs = self.documents
+        row_ids = [doc["row_id"] for doc in documents]
+        old = list(conn.execute(select(Docs.c.id).where(Docs.c.kind == kind, Docs.c.row_id.in_(row_ids))).scalars())
+        if old:
+            if conn.dialect.name == "sqlite":
+                conn.execute(delete(fts).where(fts.c.rowid.in_(old)))
+            conn.execute(delete(Docs).where(Docs.c.id.in_(old)))
+        now = datetime.now()
+        for doc in documents:
+            doc.update(kind=kind, title=(doc["title"] or "")[:255], indexed_at=now)
+        ids = list(conn.scalars(insert(Docs).returning(Docs.c.id), documents))
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f"UPDATE search_documents SET document = to_tsvector('{TEXT_CONFIG}', body) "
+                              "WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+        else:
+            conn.execute(insert(fts), [{"rowid": doc_id, "body": doc["body"]} for doc_id, doc in zip(ids, documents)])
+
+    def _sync_one(self, conn, source, rebuild):
+        State = self.state
+        model = source.model
+        state = conn.execute(select(State).where(State.c.kind == source.kind)).first()
+        last_id = 0 if rebuild or state is None else state.last_id
+        started = datetime.now()
+        indexed = 0
+        if state is not None and not rebuild:
+            # On Postgres a row can commit after a row with a higher id was indexed; pick up any in the
+            # last RESCAN_IDS ids that still have no document (an index-only probe per id)
+            Docs = self.documents
+            indexed_already = select(Docs.c.id).where(Docs.c.kind == source.kind, Docs.c.row_id == model.id)
+            rows = conn.execute(select(model).where(model.id > last_id - RESCAN_IDS, model.id <= last_id,
+                                                    ~indexed_already.exists())).all()
+            if rows:
+                self._write(conn, source.kind, source.documents(conn, rows))
+                indexed += len(rows)
+        while True:
+            rows = conn.execute(select(model).where(model.id > last_id).order_by(model.id).limit(SYNC_CHUNK)).all()
+            if not rows:
+                break
+            self._write(conn, source.kind, source.documents(conn, rows))
+            indexed += len(rows)
+            last_id = rows[-1].id
+        if source.changed is not None and state is not None and not rebuild:
+            rows = conn.execute(select(model).where(model.id.in_(source.changed(state.synced_at)),
+                                                    model.id <= last_id)).all()
+            if rows:
+                self._write(conn, source.kind, source.documents(conn, rows))
+                indexed += len(rows)
+        values = {"last_id": last_id, "synced_at": started}
+        if state is None:
+            conn.execute(insert(State).values(kind=source.kind, **values))
+        else:
+            conn.execute(update(State).where(State.c.kind == source.kind).values(values))
+        return indexed
+
+    def sync(self, rebuild=False):
+        # {kind: documents written}; {} if another worker is syncing
+        with self.app.app_context():
+            with self.db.engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    locked = conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"),
+                                          {"key": SEARCH_LOCK_KEY}).scalar()
+                    if not locked:
+                        return {}
+                if rebuild:
+                    if conn.dialect.name == "sqlite":
+                        conn.execute(delete(fts))
+                    conn.execute(delete(self.documents))
+                return {kind: self._sync_one(conn, source, rebuild) for kind, source in self.sources.items()}
+
+    def maybe_sync(self):
+        # Unlike analytics, concurrent searches wait for a running sync so a row just written is found
+        if time.monotonic() - self._checked_at < self.sync_seconds:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.sync_seconds:
+                self.sync()
+                self._checked_at = time.monotonic()
+
+    def _has_trigram(self, conn):
+        if self._trigram is None:
+            self._trigram = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+        return self._trigram
+
+    def _matches(self, conn, words, fuzzy):
+        # (select of documents with a `score` column, lower is better) for one query
+        Docs = self.documents
+        if conn.dialect.name == "postgresql":
+            if fuzzy:
+                # `<%` can use the trigram index on title; the threshold is checked again for a stable cut-off
+                phrase = literal(" ".join(words), String)
+                similarity = func.word_similarity(phrase, Docs.c.title)
+                return (select(Docs, (-similarity).label("score"))
+                        .where(phrase.op("<%")(Docs.c.title), similarity >= TRIGRAM_THRESHOLD))
+            # Every word must match, as a prefix so "bir" finds "biryani"
+            query = func.to_tsquery(TEXT_CONFIG, " & ".join(f"{word}:*" for word in words))
+            document = literal_column("search_documents.document")
+            return (select(Docs, (-func.ts_rank(document, query)).label("score"))
+                    .where(document.op("@@")(query)))
+        match = " AND ".join(f'"{word}"*' for word in words)
+        return (select(Docs, literal_column("bm25(search_fts)").label("score"))
+                .join(fts, fts.c.rowid == Docs.c.id)
+                .where(text("search_fts MATCH :match").bindparams(match=match)))
+
+    def search(self, query, kinds=None, near=None, radius_km=None, limit=20, after=None):
+        """One page of documents matching every word of ``query``, best first.
+
+        ``near`` is ``(latitude, longitude)``; with it only documents within
+        ``radius_km`` are returned, each with its ``distance_km``. ``after``
+        is the ``(fuzzy, score, id)`` of the last document of the previous
+        page, so later pages keep the matching mode of the first.
+        Returns ``(documents, (fuzzy, score, id) of the last one or None)``.
+        """
+        words = terms(query)
+        if not words:
+            return [], None
+        with self.db.engine.connect() as conn:
+            fuzzy = bool(after[0]) if after is not None else False
+            while True:
+                matches = self._matches(conn, words, fuzzy)
+                if kinds:
+                    matches = matches.where(self.documents.c.kind.in_(kinds))
+                if near is not None:
+                    # Bounding box in SQL; the exact distance is checked below
+                    dlat = radius_km / KM_PER_DEGREE
+                    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(near[0])), 0.01))
+                    matches = matches.where(self.documents.c.latitude.between(near[0] - dlat, near[0] + dlat),
+                                            self.documents.c.longitude.between(near[1] - dlon, near[1] + dlon))
+                ranked = matches.subquery()
+                page = select(ranked)
+                if after is not None:
+                    page = page.where(or_(ranked.c.score > after[1],
+                                          and_(ranked.c.score == after[1], ranked.c.id > after[2])))
+                rows = conn.execute(page.order_by(ranked.c.score, ranked.c.id).limit(limit + 1)).mappings().all()
+                # Nothing matched exactly on the first page: try trigram similarity, which tolerates misspellings
+                if rows or fuzzy or after is not None or conn.dialect.name != "postgresql" or not self._has_trigram(conn):
+                    break
+                fuzzy = True
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        last = (fuzzy, rows[-1]["score"], rows[-1]["id"]) if more else None
+        results = []
+        for row in rows:
+            result = {
+                "kind": row["kind"], "id": row["row_id"], "title": row["title"], "location": row["location"],
+                "latitude": row["latitude"], "longitude": row["longitude"],
+                "score": round(-row["score"], 4),
+                "fuzzy": fuzzy,
+            }
+            if near is not None:
+                result["distance_km"] = round(haversine_km(near[0], near[1], row["latitude"], row["longitude"]), 2)
+                if result["distance_km"] > radius_km:
+                    continue  # In the bounding box's corners
+            results.append(result)
+        return results, last
+
+
+def build_sources():
+    from app import Donation, EmergencyDonation, FoodAidRequest, PredictionJob
+
+    def join(*parts):
+        return " ".join(part for part in parts if part)
+
+    def point(row):
+        return {"location": row.location, "latitude": row.latitude, "longitude": row.longitude}
+
+    def donations(conn, rows):
+        # The predicted food class is searchable too, once a prediction job has run
+        predicted = dict(conn.execute(
+            select(PredictionJob.donation_id, PredictionJob.food_name)
+            .where(PredictionJob.donation_id.in_([row.id for row in rows]), PredictionJob.status == "done")
+            .order_by(PredictionJob.id)
+        ).all())
+        return [dict(point(row), row_id=row.id, title=row.food_type,
+                     body=join(row.food_type, row.food_category, row.food_preference, row.notes, row.location,
+                               (predicted.get(row.id) or "").replace("_", " ")))
+                for row in rows]
+
+    def emergency_donations(conn, rows):
+        return [dict(point(row), row_id=row.id, title=row.food_type,
+                     body=join(row.food_type, row.donation_type, row.comments, row.location))
+                for row in rows]
+
+    def food_aid_requests(conn, rows):
+        return [dict(point(row), row_id=row.id, title=row.aid_type,
+                     body=join(row.aid_type, row.organization_type, row.comments, row.location))
+                for row in rows]
+
+    def predictions_done(since):
+        return select(PredictionJob.donation_id).where(PredictionJob.status == "done",
+                                                       PredictionJob.updated_at >= since)
+
+    return [
+        Source("donation", Donation, donations, changed=predictions_done),
+        Source("emergency_donation", EmergencyDonation, emergency_donations),
+        Source("food_aid_request", FoodAidRequest, food_aid_requests),
+    ]
+
+
+def index_from_env(app, db, document_model, state_model):
+    return SearchIndex(app, db, document_model, state_model, build_sources(),
+                       sync_seconds=float(os.environ.get("SEARCH_SYNC_SECONDS", 5)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the search index up to date")
+    parser.add_argument("--rebuild", action="store_true", help="drop every document and index all rows again")
+    args = parser.parse_args()
+
+    from app import search_index
+
+    started = time.perf_counter()
+    result = search_index.sync(rebuild=args.rebuild)
+    print(json.dumps({"indexed": result, "seconds": round(time.perf_counter() - started, 3)}, indent=2))
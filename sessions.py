@@ -0,0 +1,262 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.datastructures import CallbackDict
+
+from instrumentation import SESSION_LOOKUPS, get_logger, log_event
+
+log = get_logger("sessions")
+
+_serializer = TaggedJSONSerializer()  # Same encoding Flask uses for cookie sessions
+
+# INSERT ... ON CONFLICT DO UPDATE where the dialect has it
+UPSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def load_secret_key(app):
+    # SECRET_KEY, or a key generated once and kept in the instance folder so that
+    # restarts and every worker on this host agree on it
+    key = os.environ.get("SECRET_KEY")
+    if key:
+        return key
+    path = os.path.join(app.instance_path, "secret_key")
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(app.instance_path, exist_ok=True)
+    key = secrets.token_hex(32)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another process created it first
+        with open(path, "r") as f:
+            return f.read().strip()
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+    log_event(log, logging.WARNING, "generated a secret key; set SECRET_KEY where the instance folder is not kept",
+              path=path)
+    return key
+
+
+class MemoryStore:
+    """LRU of session data in this process.
+
+    With a shared store behind it, entries are only trusted for
+    ``ttl_seconds``; after that they are read again, so a logout in another
+    worker takes effect here within that time.
+    """
+
+    def __init__(self, max_entries=10000, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # sid -> (data, expires_at, cached_at)
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._entries.clear()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            data, expires_at, cached_at = entry
+            stale = self.ttl_seconds is not None and time.monotonic() - cached_at > self.ttl_seconds
+            if stale or expires_at <= datetime.now():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return data, expires_at
+
+    def set(self, sid, data, expires_at):
+        with self._lock:
+            self._entries[sid] = (data, expires_at, time.monotonic())
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class TableStore:
+    """Sessions in a database table, shared by every worker.
+
+    Uses its own short transactions on the engine so session writes never
+    mix with the view's ORM session.
+    """
+
+    PURGE_INTERVAL = 3600  # Seconds between deletes of expired rows, per process
+
+    def __init__(self, app, db, model):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        self._purged_at = time.monotonic()
+
+    def get(self, sid):
+        table = self.table
+        with self.db.engine.connect() as conn:
+            row = conn.execute(select(table.c.data, table.c.expires_at).where(table.c.id == sid)).first()
+        if row is None or row.expires_at <= datetime.now():
+            return None
+        return _serializer.loads(row.data), row.expires_at
+
+    def set(self, sid, data, expires_at):
+        table = self.table
+        values = {"data": _serializer.dumps(data), "expires_at": expires_at}
+        with self.db.engine.begin() as conn:
+            upsert = UPSERTS.get(conn.dialect.name)
+            if upsert is not None:
+                statement = upsert(table).values(id=sid, **values)
+                conn.execute(statement.on_conflict_do_update(index_elements=[table.c.id], set_=values))
+            elif conn.execute(update(table).where(table.c.id == sid).values(values)).rowcount == 0:
+                conn.execute(table.insert().values(id=sid, **values))
+        self._maybe_purge()
+
+    def delete(self, sid):
+        with self.db.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.id == sid))
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._purged_at < self.PURGE_INTERVAL:
+            return
+        self._purged_at = time.monotonic()
+        with self.db.engine.begin() as conn:
+            removed = conn.execute(delete(self.table).where(self.table.c.expires_at <= datetime.now())).rowcount
+        if removed:
+            log_event(log, logging.INFO, "purged expired sessions", count=removed)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        # Give the session a new id when it is next saved (call on login against session fixation)
+        self.rotate = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask sessions kept on the server; the cookie only holds a signed id.
+
+    Lookups try the in-process ``local`` store first and fall back to the
+    ``shared`` one, so most authenticated requests and every anonymous one
+    are answered without a database round trip. Empty sessions are never
+    stored and set no cookie.
+    """
+
+    def __init__(self, local, shared=None, lifetime=timedelta(days=7)):
+        self.local = local
+        self.shared = shared
+        self.lifetime = lifetime
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="frn-session")
+
+    def _load(self, sid):
+        entry = self.local.get(sid)
+        if entry is not None:
+            SESSION_LOOKUPS.labels("local").inc()
+            return entry
+        if self.shared is not None:
+            entry = self.shared.get(sid)
+            if entry is not None:
+                SESSION_LOOKUPS.labels("shared").inc()
+                self.local.set(sid, *entry)
+                return entry
+        SESSION_LOOKUPS.labels("miss").inc()
+        return None
+
+    def _delete(self, sid):
+        self.local.delete(sid)
+        if self.shared is not None:
+            self.shared.delete(sid)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession()
+        try:
+            sid = self._signer(app).unsign(cookie).decode()
+        except BadSignature:
+            return ServerSession()
+        entry = self._load(sid)
+        if entry is None:
+            return ServerSession()
+        data, expires_at = entry
+        return ServerSession(data, sid=sid, expires_at=expires_at)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid is not None:
+                # Cleared, e.g. on logout
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        response.vary.add("Cookie")
+
+        sid = session.sid
+        if session.rotate and sid is not None:
+            self._delete(sid)
+            sid = None
+        # Extend the expiry on writes, and on reads once half the lifetime is used up
+        refresh = session.expires_at is None or session.expires_at - datetime.now() < self.lifetime / 2
+        if sid is not None and not session.modified and not refresh:
+            return
+
+        new = sid is None
+        sid = sid or secrets.token_urlsafe(32)
+        expires_at = datetime.now() + self.lifetime
+        data = dict(session)
+        if self.shared is not None:
+            self.shared.set(sid, data, expires_at)
+        self.local.set(sid, data, expires_at)
+        if new or session.permanent:
+            response.set_cookie(
+                name, self._signer(app).sign(sid).decode(),
+                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def session_interface_from_env(app, db, model):
+    # SESSION_BACKEND=database (default): per-worker LRU in front of the sessions table.
+    # SESSION_BACKEND=memory: LRU only; sessions do not survive restarts or cross workers.
+    backend = os.environ.get("SESSION_BACKEND", "database")
+    lifetime = timedelta(hours=float(os.environ.get("SESSION_LIFETIME_HOURS", 168)))
+    max_entries = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+    if backend == "memory":
+        return ServerSessionInterface(MemoryStore(max_entries), lifetime=lifetime)
+    if backend != "database":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    local = MemoryStore(max_entries, ttl_seconds=float(os.environ.get("SESSION_CACHE_TTL", 60)))
+    return ServerSessionInterface(local, TableStore(app, db, model), lifetime=lifetime)
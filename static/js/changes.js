@@ -0,0 +1,45 @@
+// Live updates from /api/changes/<feed>, which sends only rows added since a cursor
+
+// Current end of the feed. Take it before loading the first page so rows
+// inserted while the page loads still arrive as changes.
+async function feedCursor(feed) {
+  const response = await fetch('/api/changes/' + feed);
+  const body = await response.json();
+  return body.cursor;
+}
+
+// Call onItems(items) with every batch of new rows after `cursor`
+function followChanges(feed, cursor, onItems) {
+  if (window.EventSource) {
+    const source = new EventSource('/api/changes/' + feed + '/stream?since=' + cursor);
+    source.addEventListener('change', event => {
+      cursor = event.lastEventId;
+      onItems(JSON.parse(event.data));
+    });
+    source.onerror = () => {
+      // A busy server answers 503, which EventSource does not retry by itself
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(() => followChanges(feed, cursor, onItems), 5000);
+      }
+    };
+    return;
+  }
+  // Long-poll fallback for browsers without EventSource
+  (async function poll() {
+    while (true) {
+      try {
+        const response = await fetch('/api/changes/' + feed + '?since=' + cursor);
+        if (!response.ok) {
+          throw new Error('HTTP ' + response.status);
+        }
+        const body = await response.json();
+        cursor = body.cursor;
+        if (body.items.length) {
+          onItems(body.items);
+        }
+      } catch (error) {
+        await new Promise(resolve => setTimeout(resolve, 5000));
+      }
+    }
+  })();
+}
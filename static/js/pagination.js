@@ -0,0 +1,28 @@
+// Helpers for the paginated list APIs, which return {items, next_cursor}
+
+function pageUrl(url, cursor) {
+  if (!cursor) {
+    return url;
+  }
+  return url + (url.includes('?') ? '&' : '?') + 'cursor=' + encodeURIComponent(cursor);
+}
+
+// Show a "Load more" button after `anchor` while there are more pages
+function showLoadMore(anchor, nextCursor, loadPage) {
+  const id = anchor.id + '-load-more';
+  let button = document.getElementById(id);
+  if (!nextCursor) {
+    if (button) {
+      button.remove();
+    }
+    return;
+  }
+  if (!button) {
+    button = document.createElement('button');
+    button.id = id;
+    button.className = 'load-more';
+    button.textContent = 'Load more';
+    anchor.after(button);
+  }
+  button.onclick = () => loadPage(nextCursor);
+}
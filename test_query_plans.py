@@ -0,0 +1,58 @@
+# Hot queries must keep using their indexes. The queries are built by the same
+# code the routes run (filters, pagination, login SQL) and planned by SQLite on
+# a database created by the migrations, so a change to either that turns one
+# back into a table scan fails here.
+import os
+
+import pytest
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+
+@pytest.fixture(scope="module")
+def app_module(tmp_path_factory):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}"
+    import app
+
+    return app
+
+
+def hot_queries(app):
+    from pagination import page_query
+
+    def page(model, order_columns, filters, **args):
+        return page_query(model.query, order_columns, filters, MultiDict(args)).statement
+
+    Listing, Requirement, Item = app.BiofertilizerListing, app.NGORequirement, app.RequestedItem
+    return [
+        ("login", app.USER_BY_EMAIL.bindparams(email="a@b.c"), "sqlite_autoindex_users_1"),
+        ("my donations", app.Donation.query.filter_by(contact_name="x").statement, "ix_donations_contact_name_id"),
+        ("surplus requests", app.SurplusRequest.query.filter_by(user_id=1).statement, "ix_surplus_request_user_id"),
+        ("biofertilizer page", page(Listing, [Listing.timestamp, Listing.id], app.biofertilizer_filters()),
+         "ix_biofertilizer_listings_timestamp_id"),
+        ("biofertilizer by material",
+         page(Listing, [Listing.timestamp, Listing.id], app.biofertilizer_filters(),
+              material_type="Husk", **{"from": "2025-01-01"}),
+         "ix_biofertilizer_listings_lower_material_type_pickup_date"),
+        ("ngo page", page(Requirement, [Requirement.timestamp, Requirement.id], app.ngo_requirement_filters()),
+         "ix_ngo_requirements_timestamp_id"),
+        ("requested items by date",
+         page(Item, [Item.id], app.requested_item_filters(), **{"from": "2025-01-01", "to": "2025-01-31"}),
+         "ix_requested_items_date"),
+    ]
+
+
+def query_plan(conn, statement):
+    sql = statement.compile(conn, compile_kwargs={"literal_binds": True}).string
+    return " | ".join(row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql)))
+
+
+def test_hot_queries_use_their_indexes(app_module):
+    failures = []
+    with app_module.app.app_context():
+        with app_module.dp.engine.connect() as conn:
+            for name, statement, index in hot_queries(app_module):
+                plan = query_plan(conn, statement)
+                if index not in plan:
+                    failures.append(f"{name}: expected {index}, got {plan}")
+    assert not failures, "\n".join(failures)
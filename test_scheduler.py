@@ -0,0 +1,45 @@
+# Greedy assignment without a database: loaders return plain dicts and the
+# scheduler is marked loaded so refresh does not read existing assignments
+from datetime import datetime, timedelta
+
+from scheduler import ExpiryScheduler, Pool
+
+NOW = datetime(2026, 1, 1, 12)
+
+
+def loader(rows):
+    return lambda after_id: [row for row in rows if row["id"] > after_id]
+
+
+def scheduler_for(supplies, demands):
+    pool = Pool("biofertilizer", {"biofertilizer": loader(supplies)}, {"ngo_requirement": loader(demands)},
+                lambda supply, demand: True)
+    scheduler = ExpiryScheduler(None, None, None, [pool])
+    scheduler.loaded = True
+    scheduler.refresh(NOW)
+    return scheduler
+
+
+def supply(id, amount, latitude=12.0):
+    return {"id": id, "deadline": NOW + timedelta(days=1), "amount": amount, "latitude": latitude, "longitude": 77.0}
+
+
+def demand(id, capacity, latitude=12.0):
+    return {"id": id, "capacity": capacity, "latitude": latitude, "longitude": 77.0}
+
+
+def test_large_supply_is_split_over_demands_nearest_first():
+    rows, _ = scheduler_for([supply(1, 100)], [demand(1, 30), demand(2, 50, latitude=12.1)]).assign_batch(NOW)
+    assert [(row["demand_id"], row["amount"]) for row in rows] == [(1, 30), (2, 50)]
+
+
+def test_leftover_waits_for_a_new_demand():
+    scheduler = scheduler_for([supply(1, 100)], [demand(1, 30)])
+    rows, _ = scheduler.assign_batch(NOW)
+    assert [row["amount"] for row in rows] == [30]
+    assert len(scheduler.queue) == 0 and len(scheduler.parked["biofertilizer"]) == 1
+
+    scheduler.pools[0].demands["ngo_requirement"] = loader([demand(2, 200)])
+    scheduler.refresh(NOW)
+    rows, _ = scheduler.assign_batch(NOW)
+    assert [(row["demand_id"], row["amount"]) for row in rows] == [(2, 70)]
@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import get_logger, log_event
+
+log = get_logger("uploads")
+
+# Largest request body accepted; Flask answers 413 from Content-Length
+# before reading the body when this is exceeded
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", 16)) * 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=int(os.environ.get("UPLOAD_WRITER_THREADS", 2)),
+                                               thread_name_prefix="upload-writer")
+    return _executor
+
+
+def _reset_after_fork():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def read_upload(file_storage):
+    # Werkzeug keeps small uploads in memory and spools large ones to a temp
+    # file; either way we read the bytes once and decode from them directly
+    file_storage.stream.seek(0)
+    return file_storage.stream.read()
+
+
+def _write_file(data, filepath):
+    tmp_path = f"{filepath}.{os.getpid()}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+    return filepath
+
+
+def run_async(fn, *args):
+    # Run upload post-processing off the request path
+    future = _get_executor().submit(fn, *args)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def save_async(data, filepath):
+    # Persist the original in the background so the request can go straight
+    # to inference; returns a Future for callers that need the file on disk
+    return run_async(_write_file, data, filepath)
+
+
+def _log_failure(future):
+    error = future.exception()
+    if error is not None:
+        log_event(log, logging.ERROR, "upload processing failed", error=str(error))